@@ -0,0 +1,290 @@
+"""
+Module containing the benchmark cases: the hot paths of the server and the
+client, each set up once and timed one operation at a time
+"""
+
+import collections
+import random
+
+from common import protocol
+from common.framing import Framer
+from server.handler import Handler as ServerHandler
+from client.handler import Handler as ClientHandler
+from sim.network import SimServer
+
+CASES = collections.OrderedDict()
+
+PLAYERS = 8
+
+
+def case(name):
+    """Registers a factory that sets a case up and returns the operation
+    to time, a function without arguments."""
+    def register(factory):
+        CASES[name] = factory
+        return factory
+    return register
+
+
+class NullConnection:
+    """A server connection that encodes what it is sent and throws it
+    away, so only the work done for the message is timed."""
+
+    def __init__(self, server, port):
+        self.addr = ("127.0.0.1", port)
+        self.framer = Framer()
+        self.handler = ServerHandler(server, self)
+
+    def send(self, message, method=None):
+        self.framer.encode(message)
+
+
+def _join(handler, username, port, codec=None):
+    message = {
+        protocol.METHOD: protocol.METHOD_JOIN,
+        protocol.PLAYER_USERNAME: username,
+        protocol.PLAYER_UDP_ADDRESS: "127.0.0.1",
+        protocol.PLAYER_UDP_PORT: port,
+        protocol.FEATURES: [protocol.FEATURE_ROSTER_PUSH]
+    }
+    if codec is not None:
+        message[protocol.FRAMING] = [protocol.FRAMING_LENGTH]
+        message[protocol.CODEC] = [codec]
+    handler.handle(message)
+
+
+def _room(start=False):
+    """A room of PLAYERS players, every other one on length framing with
+    the struct codec and the rest on the legacy JSON lines."""
+    server = SimServer({"rng": random.Random(0)})
+    handlers = []
+    for i in range(PLAYERS):
+        connection = NullConnection(server, 10000 + i)
+        codec = protocol.CODEC_STRUCT if i % 2 else None
+        _join(connection.handler, "player-%d" % i, connection.addr[1], codec)
+        handlers.append(connection.handler)
+
+    room = handlers[0].room
+    if start:
+        for handler in handlers:
+            handler.handle({protocol.METHOD: protocol.METHOD_READY})
+    return room, handlers
+
+
+def _feed(framer, chunks):
+    def run():
+        for chunk in chunks:
+            for _ in framer.feed(chunk):
+                pass
+    return run
+
+
+def _chunks(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+def _large_message():
+    # a roster reply of players with long names, about 64 KB
+    return {
+        protocol.STATUS: protocol.STATUS_OK,
+        protocol.DESCRIPTION: protocol.DESC_CLIENT_LIST,
+        protocol.CLIENTS: [
+            {
+                protocol.PLAYER_ID: i,
+                protocol.PLAYER_IS_ALIVE: 1,
+                protocol.PLAYER_ADDRESS: "127.0.0.1",
+                protocol.PLAYER_PORT: 10000 + i,
+                protocol.PLAYER_USERNAME: "{\"player\"} %d \\ " % i * 40
+            }
+            for i in range(128)
+        ]
+    }
+
+
+def _many_messages():
+    messages = []
+    for i in range(250):
+        messages.append({protocol.METHOD: protocol.METHOD_KPU_SELECTED, protocol.KPU_ID: i})
+        messages.append({protocol.METHOD: protocol.METHOD_VOTE_NOW, protocol.PHASE: protocol.TIME_DAY})
+        messages.append({protocol.STATUS: protocol.STATUS_OK})
+        messages.append({
+            protocol.METHOD: protocol.METHOD_CHANGE_PHASE,
+            protocol.TIME: protocol.TIME_NIGHT,
+            protocol.DAYS: i,
+            protocol.DESCRIPTION: "Saat ini, hari telah malam"
+        })
+    return messages
+
+
+def _framer(codec=None):
+    framer = Framer()
+    if codec is not None:
+        framer.set_format(protocol.FRAMING_LENGTH, codec)
+    return framer
+
+
+def _split(codec, messages, chunk_size=None):
+    framer = _framer(codec)
+    data = b"".join(framer.encode(message) for message in messages)
+    return _feed(framer, _chunks(data, chunk_size) if chunk_size else [data])
+
+
+@case("split.json.large")
+def split_json_large():
+    return _split(None, [_large_message()])
+
+
+@case("split.json.large.chunked")
+def split_json_large_chunked():
+    return _split(None, [_large_message()], 1024)
+
+
+@case("split.length.large")
+def split_length_large():
+    return _split(protocol.CODEC_JSON, [_large_message()])
+
+
+@case("split.length.large.chunked")
+def split_length_large_chunked():
+    return _split(protocol.CODEC_JSON, [_large_message()], 1024)
+
+
+@case("split.json.many")
+def split_json_many():
+    return _split(None, _many_messages())
+
+
+@case("split.struct.many")
+def split_struct_many():
+    return _split(protocol.CODEC_STRUCT, _many_messages())
+
+
+@case("dispatch")
+def dispatch():
+    # the cheapest request there is, a roster that did not change
+    room, handlers = _room()
+    handler = handlers[0]
+    message = {
+        protocol.METHOD: protocol.METHOD_CLIENT_ADDRESS,
+        protocol.ROSTER_VERSION: room.roster_version
+    }
+    return lambda: handler.handle(message)
+
+
+@case("dispatch.not_joined")
+def dispatch_not_joined():
+    handler = NullConnection(SimServer(), 10000).handler
+    message = {protocol.METHOD: protocol.METHOD_LEAVE}
+    return lambda: handler.handle(message)
+
+
+@case("accepted_proposal.tally")
+def accepted_proposal_tally():
+    # a whole election: everyone accepts the same KPU, the one reaching the
+    # quorum announces it and the rest are turned away
+    room, handlers = _room(start=True)
+    message = {
+        protocol.METHOD: protocol.METHOD_ACCEPTED_PROPOSAL,
+        protocol.KPU_ID: handlers[0].player_id,
+        protocol.DESCRIPTION: protocol.DESC_KPU_SELECTED
+    }
+
+    def run():
+        room.selected_kpu_id = None
+        room.kpu_votes.clear()
+        room.kpu_tally.clear()
+        room.retry_vote = 2
+        for handler in handlers:
+            handler.handle(message)
+    return run
+
+
+@case("client_address.cached")
+def client_address_cached():
+    room, handlers = _room()
+    handler = handlers[1]
+    message = {protocol.METHOD: protocol.METHOD_CLIENT_ADDRESS}
+    return lambda: handler.handle(message)
+
+
+@case("client_address.build")
+def client_address_build():
+    room, handlers = _room()
+    handler = handlers[1]
+    message = {protocol.METHOD: protocol.METHOD_CLIENT_ADDRESS}
+
+    def run():
+        room.roster_frames.clear()
+        handler.handle(message)
+    return run
+
+
+@case("broadcast")
+def broadcast():
+    room, handlers = _room(start=True)
+    message = {
+        protocol.METHOD: protocol.METHOD_CHANGE_PHASE,
+        protocol.TIME: protocol.TIME_NIGHT,
+        protocol.DAYS: 1,
+        protocol.DESCRIPTION: "Saat ini, hari telah malam, warga desa yang "
+                              "kelelahan kini mulai perlahan terlelap."
+    }
+    return lambda: room.broadcast(message)
+
+
+@case("start_game")
+def start_game():
+    # includes resetting the room, start_game does nothing twice
+    room, handlers = _room()
+
+    def run():
+        room.reset_game()
+        room.start_game()
+    return run
+
+
+class VoteClient:
+    """The client state the vote counting reads, results are dropped."""
+
+    def __init__(self):
+        self.werewolf_count = 2
+        self.handler = ClientHandler(self)
+        self.clients = [
+            {
+                protocol.PLAYER_ID: i,
+                protocol.PLAYER_IS_ALIVE: 1,
+                protocol.PLAYER_ADDRESS: "127.0.0.1",
+                protocol.PLAYER_PORT: 10000 + i,
+                protocol.PLAYER_USERNAME: "player-%d" % i
+            }
+            for i in range(PLAYERS)
+        ]
+        self.game_day = 1
+        self.game_time = protocol.TIME_DAY
+        self.results = 0
+
+    def vote_result_civilian(self, vote_status, vote_result, player_killed=None):
+        self.results += 1
+
+    def vote_result_werewolf(self, vote_status, vote_result, player_killed=None):
+        self.results += 1
+
+
+@case("client.vote_count")
+def client_vote_count():
+    # the KPU counting one round of day votes, the last one decides it
+    client = VoteClient()
+    handler = client.handler
+    votes = [
+        ({
+            protocol.METHOD: protocol.METHOD_VOTE_CIVILIAN,
+            protocol.PLAYER_ID: i % 3,
+            protocol.DAYS: 1
+        }, ("127.0.0.1", 10000 + i))
+        for i in range(PLAYERS)
+    ]
+
+    def run():
+        for message, address in votes:
+            handler.handle(message, address)
+    return run
@@ -0,0 +1,73 @@
+"""
+Module containing the benchmark runner: times the cases, keeps the results
+as JSON and compares them against a baseline
+"""
+
+import json
+import platform
+import sys
+import time
+import timeit
+
+from bench.cases import CASES
+
+
+def measure(operation, repeat=5):
+    """Returns the best time of one call of operation in nanoseconds, and
+    how many calls it was taken over. Every repeat runs for at least 0.2s,
+    the best one is the least disturbed by the rest of the machine."""
+    timer = timeit.Timer(operation)
+    number, _ = timer.autorange()
+    times = timer.repeat(repeat, number)
+    return min(times) / number * 1e9, number * repeat
+
+
+def run(names=None, repeat=5, progress=None):
+    """Times the cases named, or all of them, and returns the results."""
+    results = {}
+    for name, factory in CASES.items():
+        if names is not None and name not in names:
+            continue
+        ns, calls = measure(factory(), repeat)
+        results[name] = {"ns": ns, "calls": calls}
+        if progress is not None:
+            progress(name, results[name])
+
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_implementation() + " " + platform.python_version(),
+        "machine": platform.machine(),
+        "platform": sys.platform,
+        "results": results,
+    }
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save(report, path):
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def compare(report, baseline, threshold=0.25):
+    """Returns (name, ns, baseline ns, ratio, regressed) for every case in
+    both, a case regressed when it got slower by more than threshold."""
+    rows = []
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        ratio = result["ns"] / base["ns"]
+        rows.append((name, result["ns"], base["ns"], ratio, ratio > 1 + threshold))
+    return rows
+
+
+def format_ns(ns):
+    for unit, scale in (("s", 1e9), ("ms", 1e6), ("us", 1e3)):
+        if ns >= scale:
+            return "%.2f%s" % (ns / scale, unit)
+    return "%.0fns" % ns
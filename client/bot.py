@@ -0,0 +1,167 @@
+import collections
+import random
+
+from client.player import Player
+from common import protocol
+
+
+class Strategy:
+    """Decides whom a bot votes for."""
+
+    def __init__(self, rng=None):
+        self.rng = rng or random.Random()
+
+    def choose_vote(self, bot, candidates):
+        raise NotImplementedError
+
+
+class RandomStrategy(Strategy):
+    """Votes for anyone it may, days often take more than one vote."""
+
+    def choose_vote(self, bot, candidates):
+        return self.rng.choice(sorted(candidates))
+
+
+class LowestStrategy(Strategy):
+    """Everyone votes for the lowest id, so every vote is decided at once."""
+
+    def choose_vote(self, bot, candidates):
+        return min(candidates)
+
+
+class PackStrategy(Strategy):
+    """Werewolves agree on the lowest id, civilians vote at random."""
+
+    def choose_vote(self, bot, candidates):
+        if bot.player_role == protocol.ROLE_WEREWOLF:
+            return min(candidates)
+        return self.rng.choice(sorted(candidates))
+
+
+STRATEGIES = {
+    "random": RandomStrategy,
+    "lowest": LowestStrategy,
+    "pack": PackStrategy,
+}
+
+
+class Bot(Player):
+    """A headless player for load tests. It joins under its name, gets
+    ready as soon as hold is cleared, votes by its strategy and records how
+    long each step of the game took, in seconds of its clock:
+
+        start     from sending the join until the game started
+        election  from a day starting until its KPU was selected
+        vote      from sending a vote until the server moved on
+    """
+
+    def __init__(self, host, port, name, room=None, strategy=None, **kwargs):
+        super().__init__(host, port, room, **kwargs)
+        self.name = name
+        self.strategy = strategy or RandomStrategy()
+        self.hold = False
+
+        self.timings = collections.defaultdict(list)
+        self.join_sent = None
+        self.day_started = None
+        self.vote_sent = None
+
+    def display(self, text=""):
+        pass
+
+    def choose_name(self):
+        # a bot does not try another name when the room refuses it
+        if self.join_request is not None:
+            return None
+        self.join_sent = self.clock.now()
+        return self.name
+
+    def confirm_ready(self):
+        return not self.hold
+
+    def choose_vote(self, candidates):
+        if not candidates:
+            return None
+        kill_id = self.strategy.choose_vote(self, candidates)
+        self.vote_sent = self.clock.now()
+        return kill_id
+
+    def notify(self, event):
+        now = self.clock.now()
+        if event == protocol.METHOD_START:
+            self.timings["start"].append(now - self.join_sent)
+            self.day_started = now
+        elif event == protocol.METHOD_CHANGE_PHASE and self.game_time == protocol.TIME_DAY:
+            self.day_started = now
+        elif event == protocol.METHOD_KPU_SELECTED and self.day_started is not None:
+            self.timings["election"].append(now - self.day_started)
+            self.day_started = None
+
+        if self.vote_sent is not None and event in (
+                protocol.METHOD_VOTE_NOW, protocol.METHOD_CHANGE_PHASE, protocol.METHOD_GAME_OVER):
+            self.timings["vote"].append(now - self.vote_sent)
+            self.vote_sent = None
+        super().notify(event)
+
+
+class BotGame:
+    """The bots playing one game in their own room."""
+
+    def __init__(self, room, bots, started):
+        self.room = room
+        self.bots = bots
+        self.started = started
+        self.finished = None
+        self.completed = False
+
+    def step(self):
+        """Steps every bot and returns whether the game goes on."""
+        # the room starts as soon as everyone in it is ready, so the
+        # bots wait until all of them have joined
+        if all(bot.is_joined or not bot.keep_running for bot in self.bots):
+            for bot in self.bots:
+                bot.hold = False
+
+        running = False
+        for bot in self.bots:
+            if bot.step():
+                running = True
+
+        if not running:
+            self.completed = any(bot.is_game_over for bot in self.bots)
+        return running
+
+    def close(self, finished):
+        self.finished = finished
+        for bot in self.bots:
+            bot.close()
+
+
+def percentile(values, p):
+    # nearest rank
+    index = max(0, -(-len(values) * p // 100) - 1)
+    return values[index]
+
+
+def report(games, elapsed, percentiles=(50, 90, 99)):
+    """Prints the games per second and the timings of the bots in the
+    completed games."""
+    completed = [game for game in games if game.completed]
+    print("%d game(s) completed, %d failed in %.1fs: %.2f games/s" % (
+        len(completed), len(games) - len(completed), elapsed, len(completed) / elapsed))
+
+    timings = {"start": [], "election": [], "vote": []}
+    for game in completed:
+        for bot in game.bots:
+            for name, values in bot.timings.items():
+                timings[name].extend(values)
+
+    print("%-10s %8s" % ("", "count") + "".join(" %8s" % ("p%d" % p) for p in percentiles) + " %8s" % "max")
+    for name, values in timings.items():
+        line = "%-10s %8d" % (name, len(values))
+        if values:
+            values.sort()
+            for p in percentiles:
+                line += " %6.1fms" % (percentile(values, p) * 1000)
+            line += " %6.1fms" % (values[-1] * 1000)
+        print(line)
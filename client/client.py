@@ -1,67 +1,119 @@
+import collections
+import logging
 import socket
 import select
 import threading
 import time
-import json
-import random
 
 from client.handler import Handler
+from client.paxos import Proposer, DUELING
+from client.reliable import ReliableChannel
+from common import log
 from common import protocol
+from common.clock import Clock
+from common.faults import FaultModel
+from common.framing import Framer
+
+logger = logging.getLogger(__name__)
 
 
 class Client:
 
-    def __init__(self, host, port, verbose=None):
-        self.verbose = verbose
+    def __init__(self, host, port, election=DUELING, reliable=False, loss=0.25, faults=None,
+                 clock=None, rng=None, connection=None):
         self.keep_running = True
         self.poll_time = 0.1
 
+        # peer messages sent as unreliable are dropped at this rate, the
+        # reliable channel retransmits them until they get through
+        self.reliable = reliable
+        self.loss = loss
+
+        # a simulation passes its own clock, random generator and
+        # connection factory, called as connection(client, handler, host, port)
+        self.clock = clock or Clock()
+        # network faults injected on everything this client sends, see
+        # FaultModel for the options
+        self.faults = FaultModel(self.clock, **(faults or {}))
+
+        # formats advertised at join, in order of preference
+        self.framings = [protocol.FRAMING_LENGTH, protocol.FRAMING_JSON]
+        self.codecs = [protocol.CODEC_STRUCT, protocol.CODEC_JSON]
+        self.features = [protocol.FEATURE_ROSTER_PUSH, protocol.FEATURE_HEARTBEAT]
+
+        self.proposer = Proposer(self, self.clock, rng, election)
         self.handler = Handler(self)
-        self.connection = Connection(self, self.handler, host, port)
+        self.connection = (connection or Connection)(self, self.handler, host, port)
         self.cv = threading.Condition()
 
     def close(self):
-        if not self.keep_running:
-            return
+        # also after the server went away, to stop the threads and timers
         self.keep_running = False
+        self.proposer.stop()
         self.connection.close()
+        self.clock.close()
+
+    def notify(self, event):
+        """Called by the handler whenever the game moves on, with the
+        method or reply that moved it, or None when the server is gone."""
+        with self.cv:
+            self.cv.notify_all()
+
+    def display(self, text=""):
+        """Shows game text to the player."""
+        print(text)
 
-    def join(self, username):
-        data = json.dumps({
+    def join(self, username, room=None):
+        data = {
             protocol.METHOD: protocol.METHOD_JOIN,
             protocol.PLAYER_USERNAME: username,
             protocol.PLAYER_UDP_ADDRESS: self.connection.address,
-            protocol.PLAYER_UDP_PORT: self.connection.port
-        })
+            protocol.PLAYER_UDP_PORT: self.connection.port,
+            protocol.FRAMING: self.framings,
+            protocol.CODEC: self.codecs,
+            protocol.FEATURES: self.features
+        }
+        if room is not None:
+            data[protocol.ROOM] = room
         self.server_state = protocol.METHOD_JOIN
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
 
     def leave(self):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_LEAVE
-        })
+        }
         self.server_state = protocol.METHOD_LEAVE
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
 
     def ready(self):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_READY
-        })
+        }
         self.server_state = protocol.METHOD_READY
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
 
     def client_address(self):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_CLIENT_ADDRESS
-        })
+        }
+        # the server only sends the list back if it changed since then
+        if self.roster_version is not None:
+            data[protocol.ROSTER_VERSION] = self.roster_version
         self.server_state = protocol.METHOD_CLIENT_ADDRESS
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
+
+    def pong(self):
+        data = {
+            protocol.METHOD: protocol.METHOD_PONG
+        }
+        # the server does not answer a pong
+        self.connection.server_send(data, reply=False)
 
     def prepare_proposal(self, proposal_id, address):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_PREPARE_PROPOSAL,
             protocol.PROPOSAL_ID: proposal_id
-        })
+        }
         self.state = protocol.METHOD_PREPARE_PROPOSAL
         self.connection.send(data, address, unreliable=True)
 
@@ -69,62 +121,75 @@ class Client:
         data = {
             protocol.STATUS: protocol.STATUS_OK,
             protocol.DESCRIPTION: protocol.DESC_ACCEPTED,
+            protocol.REPLY_TO: protocol.METHOD_PREPARE_PROPOSAL,
+            protocol.PROPOSAL_ID: proposal_id
         }
         if previous_accepted_kpu_id is not None:
             data[protocol.KPU_PREV_ACCEPTED] = previous_accepted_kpu_id
-        self.connection.send(json.dumps(data), address, unreliable=True)
+        self.connection.send(data, address, unreliable=True)
 
-    def prepare_proposal_reject(self, proposal_id, address):
+    def prepare_proposal_reject(self, proposal_id, promised_id, address):
         data = {
             protocol.STATUS: protocol.STATUS_FAIL,
-            protocol.DESCRIPTION: protocol.DESC_REJECTED
+            protocol.DESCRIPTION: protocol.DESC_REJECTED,
+            protocol.PROMISED_ID: promised_id,
+            protocol.REPLY_TO: protocol.METHOD_PREPARE_PROPOSAL,
+            protocol.PROPOSAL_ID: proposal_id
         }
-        self.connection.send(json.dumps(data), address, unreliable=True)
+        self.connection.send(data, address, unreliable=True)
 
     def accept_proposal(self, proposal_id, kpu_id, address):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_ACCEPT_PROPOSAL,
             protocol.PROPOSAL_ID: proposal_id,
             protocol.KPU_ID: kpu_id
-        })
+        }
         self.state = protocol.METHOD_ACCEPT_PROPOSAL
         self.connection.send(data, address, unreliable=True)
 
-    def accept_proposal_accept(self, kpu_id, address):
-        data = json.dumps({
+    def accept_proposal_accept(self, proposal_id, kpu_id, address):
+        data = {
             protocol.STATUS: protocol.STATUS_OK,
-            protocol.DESCRIPTION: protocol.DESC_ACCEPTED
-        })
+            protocol.DESCRIPTION: protocol.DESC_ACCEPTED,
+            protocol.REPLY_TO: protocol.METHOD_ACCEPT_PROPOSAL,
+            protocol.PROPOSAL_ID: proposal_id
+        }
         self.connection.send(data, address, unreliable=True)
 
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_ACCEPTED_PROPOSAL,
             protocol.KPU_ID: kpu_id,
             protocol.DESCRIPTION: protocol.DESC_KPU_SELECTED
-        })
-        self.server_state = protocol.METHOD_ACCEPTED_PROPOSAL
-        self.connection.server_send(data)
+        }
+        # acceptances can still go out once voting has begun, the game
+        # state must stay where the server put it
+        return self.connection.server_send(data)
 
-    def accept_proposal_reject(self, address):
-        data = json.dumps({
+    def accept_proposal_reject(self, proposal_id, promised_id, address):
+        data = {
             protocol.STATUS: protocol.STATUS_FAIL,
-            protocol.DESCRIPTION: protocol.DESC_REJECTED
-        })
+            protocol.DESCRIPTION: protocol.DESC_REJECTED,
+            protocol.PROMISED_ID: promised_id,
+            protocol.REPLY_TO: protocol.METHOD_ACCEPT_PROPOSAL,
+            protocol.PROPOSAL_ID: proposal_id
+        }
         self.connection.send(data, address, unreliable=True)
 
     def vote_civilian(self, player_id, address):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_VOTE_CIVILIAN,
-            protocol.PLAYER_ID: player_id
-        })
+            protocol.PLAYER_ID: player_id,
+            protocol.DAYS: self.game_day
+        }
         self.state = protocol.METHOD_VOTE_CIVILIAN
         self.connection.send(data, address)
 
     def vote_werewolf(self, player_id, address):
-        data = json.dumps({
+        data = {
             protocol.METHOD: protocol.METHOD_VOTE_WEREWOLF,
-            protocol.PLAYER_ID: player_id
-        })
+            protocol.PLAYER_ID: player_id,
+            protocol.DAYS: self.game_day
+        }
         self.state = protocol.METHOD_VOTE_WEREWOLF
         self.connection.send(data, address)
 
@@ -136,9 +201,8 @@ class Client:
         }
         if player_killed is not None:
             data[protocol.PLAYER_KILLED] = player_killed
-        data = json.dumps(data)
         self.server_state = protocol.METHOD_VOTE_RESULT_CIVILIAN
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
 
     def vote_result_werewolf(self, vote_status, vote_result, player_killed=None):
         data = {
@@ -148,9 +212,29 @@ class Client:
         }
         if player_killed is not None:
             data[protocol.PLAYER_KILLED] = player_killed
-        data = json.dumps(data)
         self.server_state = protocol.METHOD_VOTE_RESULT_CIVILIAN
-        self.connection.server_send(data)
+        return self.connection.server_send(data)
+
+class Request:
+    """A request sent to the server. The server answers every request with
+    exactly one status message, in order, so replies are matched to
+    requests first in, first out."""
+
+    def __init__(self, message):
+        self.method = message.get(protocol.METHOD)
+        self.response = None
+        self.event = threading.Event()
+
+    def complete(self, response):
+        self.response = response
+        self.event.set()
+
+    def wait(self, timeout=None):
+        """Blocks until the reply arrives and returns it, or returns None
+        on timeout or when the connection is lost."""
+        self.event.wait(timeout)
+        return self.response
+
 
 class Connection:
 
@@ -167,6 +251,11 @@ class Connection:
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.connect((self.server_host, self.server_port))
         self.server_socket.setblocking(0)
+        self.server_framer = Framer()
+        self.framer = Framer()
+        self.loss = client.loss
+        self.faults = client.faults
+        self.channel = ReliableChannel(self, client.clock) if client.reliable else None
 
         # workaround to get local IP
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -183,9 +272,10 @@ class Connection:
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(('', 0))
         _, self.port = self.socket.getsockname()
-        self.client.verbose and print("Listening UDP at %s:%d" % (self.address, self.port))
+        logger.debug("Listening UDP at %s:%d", self.address, self.port)
 
         self.lock = threading.Lock()
+        self.requests = collections.deque()
         self.server_thread = threading.Thread(target=self.server_recv)
         self.server_thread.start()
         self.thread = threading.Thread(target=self.recv)
@@ -195,34 +285,7 @@ class Connection:
         self.server_thread.join()
         self.thread.join()
 
-    def _split(self, messages):
-        last_messages = []
-        idx = messages.find(protocol.PROTOCOL_START)
-        while idx >= 0:
-            level = 1
-            for i in range(idx+1, len(messages)):
-                if messages[i] == protocol.PROTOCOL_START:
-                    level += 1
-                elif messages[i] == protocol.PROTOCOL_END:
-                    level -= 1
-                    if level == 0:
-                        idx = i
-                        break
-            # split message from PROTOCOL_END marker
-            message = messages[:idx+1]
-            messages = messages[idx+1:]
-
-            # try to load as json
-            message = json.loads(message)
-            last_messages.append(message)
-
-            # continue find PROTOCOL_END
-            idx = messages.find(protocol.PROTOCOL_END)
-
-        return last_messages
-
     def server_recv(self):
-        messages = []
         while self.client.keep_running:
             try:
                 readable, _, _ = select.select([self.server_socket], [], [], self.timeout)
@@ -234,19 +297,14 @@ class Connection:
                 # server disconnected
                 if not data:
                     self.client.keep_running = False
-                    with self.client.cv:
-                        self.client.cv.notify_all()
+                    self.fail_requests()
+                    self.client.notify(None)
                     break
 
-                message = data.decode('utf-8').strip("\n")
-                messages.append(message)
-
-                if message.endswith(protocol.PROTOCOL_END):
-                    message = self._split("".join(messages))
-                    for m in message:
-                        self.client.verbose and print("Recv:", m)
-                        self.handler.server_handle(m)
-                    messages.clear()
+                for m in self.server_framer.feed(data):
+                    if log.sample_payload():
+                        logger.debug("Recv: %r", m)
+                    self.handler.server_handle(m)
 
             except select.error:
                 break
@@ -254,7 +312,7 @@ class Connection:
         self.server_socket.close()
 
     def recv(self):
-        messages = {}
+        framers = {}
         while self.client.keep_running:
             try:
                 readable, _, _ = select.select([self.socket], [], [], self.timeout)
@@ -266,39 +324,33 @@ class Connection:
                 if not data:
                     continue
 
-                message = data.decode('utf-8').strip("\n")
-                if address not in messages:
-                    messages[address] = []
-                messages[address].append(message)
+                if address not in framers:
+                    framers[address] = Framer()
 
-                if message.endswith(protocol.PROTOCOL_END):
-                    message = self._split("".join(messages[address]))
-                    for m in message:
-                        self.client.verbose and print("Recv from %s:%d:" % (address), m)
-                        self.handler.handle(m, address)
-                    messages[address].clear()
+                for m in framers[address].feed(data):
+                    if log.sample_payload():
+                        logger.debug("Recv from %s:%d: %r", address[0], address[1], m)
+                    if self.channel is not None:
+                        m = self.channel.receive(m, address)
+                        if m is None:
+                            continue
+                    self.handler.handle(m, address)
 
             except select.error:
                 break
 
         self.socket.close()
 
-    def _str_to_byte(self, s):
-        if isinstance(s, bytes):
-            return s
-        if not isinstance(s, str):
-            s = str(s)
-        return s.encode()
-
     def _server_send(self, socket, message):
-        message = self._str_to_byte(message)
+        message = self.server_framer.encode(message)
         total_sent = 0
         while self.client.keep_running and total_sent < len(message):
             _, writable, _ = select.select([], [socket], [], self.timeout)
             if socket not in writable:
                 continue
 
-            self.client.verbose and print("Send:", message.decode('utf-8'))
+            if log.sample_payload():
+                logger.debug("Send: %r", message)
             sent = socket.send(message[total_sent:])
             if sent == 0:
                 return False
@@ -306,28 +358,58 @@ class Connection:
         return True
 
     def _send(self, message, address):
-        message = self._str_to_byte(message)
+        message = self.framer.encode(message)
         total_sent = 0
         while self.client.keep_running and total_sent < len(message):
             _, writable, _ = select.select([], [self.socket], [], self.timeout)
             if self.socket not in writable:
                 continue
 
-            self.client.verbose and print("Send to %s:%d:" % (address), message.decode('utf-8'))
+            if log.sample_payload():
+                logger.debug("Send to %s:%d: %r", address[0], address[1], message)
             sent = self.socket.sendto(message[total_sent:], address)
             if sent == 0:
                 return False
             total_sent += sent
         return True
 
-    def server_send(self, message):
+    def server_send(self, message, reply=True):
+        request = Request(message) if reply else None
+        # both the UDP and the main thread talk to the server, queue the
+        # request in the same order it goes out on the wire
+        with self.lock:
+            if request is not None:
+                self.requests.append(request)
+            self.faults.stream(self._server_write, message)
+        return request
+
+    def _server_write(self, message):
         if not self._server_send(self.server_socket, message):
             self.client.keep_running = False
+            self.fail_requests()
+
+    def pop_request(self):
+        try:
+            return self.requests.popleft()
+        except IndexError:
+            return None
+
+    def fail_requests(self):
+        while self.requests:
+            self.requests.popleft().complete(None)
 
     def send(self, message, address, unreliable=False):
-        if unreliable and random.randint(1, 100) >= 75:
-            self.client.verbose and print("Send to %s:%d: Failed (unreliable)" % (address))
+        if self.channel is not None:
+            self.channel.send(message, address, unreliable)
+        else:
+            self.transmit(message, address, unreliable)
+
+    def transmit(self, message, address, unreliable=False):
+        if unreliable and self.faults.rng.random() < self.loss:
+            logger.debug("Send to %s:%d: dropped (unreliable)", address[0], address[1])
             return
+        self.faults.datagram(self._transmit, message, address)
 
+    def _transmit(self, message, address):
         if not self._send(message, address):
             self.client.keep_running = False
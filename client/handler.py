@@ -1,3 +1,4 @@
+import collections
 import threading
 
 from common import protocol
@@ -10,30 +11,42 @@ class Handler:
 
         self.client.player_id = None
         self.client.clients = None
+        self.client.roster_version = None
         self.client.is_joined = False
 
         self.client.state = None
         self.client.server_state = None
+        self.client.renew_kpu_id = None
+        self.client.kpu_id = None
+        self.client.kpu_address = None
+        self.client.game_day = 0
+        self.client.game_time = None
+        self.client.vote_number = 0
 
         self.is_leader_election = False
         self.handler_lock = threading.Lock()
+        self.early_votes = []
+        self._reset_votes()
 
     def handle(self, message, address):
         with self.handler_lock:
             if protocol.STATUS in message:
-                status = message[protocol.STATUS]
-                state = self.client.state
+                # older peers do not say what they answer, assume it is
+                # what we sent last
+                state = message.get(protocol.REPLY_TO, self.client.state)
 
                 if state == protocol.METHOD_PREPARE_PROPOSAL:
-                    if status == protocol.STATUS_OK:
-                        self.client.accepted_count += 1
-                        if protocol.KPU_PREV_ACCEPTED in message:
-                            self.client.previous_accepted_kpu_id = message[protocol.KPU_PREV_ACCEPTED]
+                    self.client.proposer.on_promise(address, message)
+                elif state == protocol.METHOD_ACCEPT_PROPOSAL:
+                    self.client.proposer.on_accepted(address, message)
 
             elif protocol.METHOD in message:
                 method = message[protocol.METHOD]
                 self.client.state = method
 
+                if method == protocol.METHOD_PREPARE_PROPOSAL or method == protocol.METHOD_ACCEPT_PROPOSAL:
+                    self.client.proposer.on_progress()
+
                 if method == protocol.METHOD_PREPARE_PROPOSAL:
                     if protocol.PROPOSAL_ID in message:
                         proposal_id = message[protocol.PROPOSAL_ID]
@@ -42,7 +55,8 @@ class Handler:
                             self.client.prepare_proposal_accept(proposal_id, self.client.previous_accepted_kpu_id, address)
                             self.client.last_accepted_proposal_id = proposal_id
                         else:
-                            self.client.prepare_proposal_reject(proposal_id, address)
+                            self.client.prepare_proposal_reject(
+                                proposal_id, self.client.last_accepted_proposal_id, address)
 
                 elif method == protocol.METHOD_ACCEPT_PROPOSAL:
                     if protocol.PROPOSAL_ID in message:
@@ -51,96 +65,196 @@ class Handler:
                         if accepted:
                             if protocol.KPU_ID in message:
                                 kpu_id = message[protocol.KPU_ID]
-                                self.client.accept_proposal_accept(kpu_id, address)
+                                self.client.accept_proposal_accept(proposal_id, kpu_id, address)
                         else:
-                            self.client.accept_proposal_reject(address)
+                            self.client.accept_proposal_reject(
+                                proposal_id, self.client.last_accepted_proposal_id, address)
 
                 elif method == protocol.METHOD_VOTE_CIVILIAN or method == protocol.METHOD_VOTE_WEREWOLF:
-                    voting_time = self.client.game_time
-                    if voting_time == protocol.TIME_DAY and method != protocol.METHOD_VOTE_CIVILIAN:
-                        return
-                    elif voting_time == protocol.TIME_NIGHT and method != protocol.METHOD_VOTE_WEREWOLF:
-                        return
-
-                    if protocol.PLAYER_ID in message:
-                        dead_werewolf = 0
-                        alive_player = 0
-                        for client in self.client.clients:
-                            is_alive = client[protocol.PLAYER_IS_ALIVE]
-                            if is_alive:
-                                alive_player += 1
-                            elif client[protocol.ROLE] == protocol.ROLE_WEREWOLF:
-                                dead_werewolf += 1
-
-                        if voting_time == protocol.TIME_DAY:
-                            quorum = alive_player
-                        elif voting_time == protocol.TIME_NIGHT:
-                            quorum = 2 - dead_werewolf
-
-                        kill_id = message[protocol.PLAYER_ID]
-                        if kill_id not in self.vote_count:
-                            self.vote_count[kill_id] = set([address])
-                        else:
-                            self.vote_count[kill_id].add(address)
-
-                        count = 0
-                        vote_max = 0
-                        player_killed = None
-                        vote_array = []
-                        for kill_id, voters in self.vote_count.items():
-                            vote = len(voters)
-                            count += vote
-                            if vote >= (quorum//2+1):
-                                player_killed = kill_id
-                            vote_array.append([kill_id, vote])
-
-                        if count >= quorum:
-                            if player_killed is None:
-                                if voting_time == protocol.TIME_DAY:
-                                    self.client.vote_result_civilian(-1, vote_array)
-                                else:
-                                    self.client.vote_result_werewolf(-1, vote_array)
-                            else:
-                                if voting_time == protocol.TIME_DAY:
-                                    self.client.vote_result_civilian(1, vote_array, player_killed)
-                                else:
-                                    self.client.vote_result_werewolf(1, vote_array, player_killed)
-                            self.vote_count = {}
+                    self._handle_vote(method, message, address)
+
+    def _handle_vote(self, method, message, address):
+        voting_time = protocol.TIME_DAY if method == protocol.METHOD_VOTE_CIVILIAN else protocol.TIME_NIGHT
+        # older peers do not say which day they vote in
+        phase = self._phase(message.get(protocol.DAYS, self.client.game_day), voting_time)
+        current = self._phase(self.client.game_day, self.client.game_time)
+        if phase > current:
+            # the vote overtook the phase change on our server connection,
+            # count it once we get there
+            self.early_votes.append((method, message, address))
+            return
+        elif phase < current:
+            return
+
+        if protocol.PLAYER_ID in message:
+            # the roster only changes between rounds, so the
+            # quorum is counted once and every vote is O(1)
+            if self.vote_quorum is None:
+                self.vote_quorum = self._vote_quorum(voting_time)
+
+            kill_id = message[protocol.PLAYER_ID]
+            previous = self.voters.get(address)
+            if previous is not None:
+                self.vote_count[previous] -= 1
+            self.voters[address] = kill_id
+            self.vote_count[kill_id] += 1
+
+            if len(self.voters) >= self.vote_quorum:
+                player_killed = None
+                vote_array = []
+                for kill_id, vote in self.vote_count.items():
+                    if vote <= 0:
+                        continue
+                    if vote >= (self.vote_quorum//2+1):
+                        player_killed = kill_id
+                    vote_array.append([kill_id, vote])
+
+                if player_killed is None:
+                    if voting_time == protocol.TIME_DAY:
+                        self.client.vote_result_civilian(-1, vote_array)
+                    else:
+                        self.client.vote_result_werewolf(-1, vote_array)
+                else:
+                    if voting_time == protocol.TIME_DAY:
+                        self.client.vote_result_civilian(1, vote_array, player_killed)
+                    else:
+                        self.client.vote_result_werewolf(1, vote_array, player_killed)
+                self._reset_votes()
+
+    def _phase(self, day, time):
+        return day, time == protocol.TIME_NIGHT
+
+    def _replay_votes(self):
+        votes, self.early_votes = self.early_votes, []
+        for vote in votes:
+            self._handle_vote(*vote)
+
+    def _update_roster(self, message):
+        clients = self.client.clients
+        if clients is None:
+            return
+
+        # a missed push leaves the roster incomplete, the next request
+        # without a version fetches it whole
+        if message.get(protocol.ROSTER_PREVIOUS_VERSION) != self.client.roster_version:
+            self.client.roster_version = None
+        else:
+            self.client.roster_version = message.get(protocol.ROSTER_VERSION)
+
+        # build a new list, the game thread may be reading the old one
+        clients = list(clients)
+        index = {
+            client[protocol.PLAYER_ID]: i for i, client in enumerate(clients)
+        }
+        for client in message.get(protocol.CLIENTS, []):
+            i = index.get(client[protocol.PLAYER_ID])
+            if i is None:
+                clients.append(client)
+            else:
+                clients[i] = client
+        removed = set(message.get(protocol.ROSTER_REMOVED, []))
+        if removed:
+            clients = [
+                client for client in clients
+                if client[protocol.PLAYER_ID] not in removed
+            ]
+        self.client.clients = clients
+        self.vote_quorum = None
+
+    def _vote_quorum(self, voting_time):
+        dead_werewolf = 0
+        alive_player = 0
+        for client in self.client.clients:
+            is_alive = client[protocol.PLAYER_IS_ALIVE]
+            if is_alive:
+                alive_player += 1
+            elif client[protocol.ROLE] == protocol.ROLE_WEREWOLF:
+                dead_werewolf += 1
+
+        if voting_time == protocol.TIME_DAY:
+            return alive_player
+        return self.client.werewolf_count - dead_werewolf
+
+    def _reset_votes(self):
+        self.voters = {}
+        self.vote_count = collections.Counter()
+        self.vote_quorum = None
+
+    def _locate_kpu(self):
+        # the KPU can be selected before our roster request is answered,
+        # it is then looked up once the roster arrives
+        if self.client.kpu_address is not None or self.client.clients is None:
+            return
+        for client in self.client.clients:
+            if client[protocol.PLAYER_ID] == self.client.kpu_id:
+                self.client.display("Pemain '%s' terpilih menjadi ketua KPU!" % (client[protocol.PLAYER_USERNAME]))
+                self.client.kpu_address = client[protocol.PLAYER_ADDRESS]
+                self.client.kpu_port = client[protocol.PLAYER_PORT]
+                break
 
     def server_handle(self, message):
         with self.handler_lock:
+            # pushed updates arrive between replies, they must not disturb
+            # the request state
+            method = message.get(protocol.METHOD)
+            if method == protocol.METHOD_ROSTER_UPDATE:
+                self._update_roster(message)
+                return
+            elif method == protocol.METHOD_PING:
+                self.client.pong()
+                return
+
             if protocol.STATUS in message:
                 status = message[protocol.STATUS]
-                server_state = self.client.server_state
+
+                # replies come in request order, so the request tells what
+                # this reply answers even if the state moved on meanwhile
+                request = self.client.connection.pop_request()
+                if request is not None:
+                    server_state = request.method
+                else:
+                    server_state = self.client.server_state
 
                 if server_state == protocol.METHOD_JOIN:
                     if status == protocol.STATUS_OK:
+                        # the pollers read is_joined without the lock and
+                        # send right away, in the format switched to here
+                        if protocol.FRAMING in message and protocol.CODEC in message:
+                            self.client.connection.server_framer.set_format(
+                                message[protocol.FRAMING], message[protocol.CODEC])
                         if protocol.PLAYER_ID in message:
-                            self.client.is_joined = True
                             self.client.player_id = message[protocol.PLAYER_ID]
+                            self.client.is_joined = True
                     else:
                         if protocol.DESCRIPTION in message:
-                            print(message[protocol.DESCRIPTION])
-                    with self.client.cv:
-                        self.client.cv.notify_all()
+                            self.client.display(message[protocol.DESCRIPTION])
+                    self.client.notify(server_state)
 
                 elif server_state == protocol.METHOD_LEAVE:
                     pass
 
                 elif server_state == protocol.METHOD_READY:
                     if protocol.DESCRIPTION in message:
-                        print(message[protocol.DESCRIPTION])
+                        self.client.display(message[protocol.DESCRIPTION])
 
                 elif server_state == protocol.METHOD_CLIENT_ADDRESS:
                     if status == protocol.STATUS_OK:
                         if protocol.CLIENTS in message:
                             self.client.clients = message[protocol.CLIENTS]
+                            self.client.roster_version = message.get(protocol.ROSTER_VERSION)
+                            self.vote_quorum = None
 
+                        if self.client.clients is not None:
+                            self._locate_kpu()
                             if self.is_leader_election:
                                 self.is_leader_election = False
                                 self.client.server_state = protocol.METHOD_LEADER_ELECTION
-                                with self.client.cv:
-                                    self.client.cv.notify_all()
+                                self.client.notify(protocol.METHOD_LEADER_ELECTION)
+
+                # wake whoever waits on this reply, after the state above is
+                # up to date
+                if request is not None:
+                    request.complete(message)
 
             elif protocol.METHOD in message:
                 method = message[protocol.METHOD]
@@ -152,29 +266,33 @@ class Handler:
                     if protocol.ROLE in message:
                         role = message[protocol.ROLE]
                         self.client.player_role = role
-                        print()
-                        print("--- EUREUREONG | THE WEREWOLVES ---")
-                        print("Hai %s!" % (self.client.player_name))
-                        print("Tugasmu adalah menjadi: %s." % (role))
+                        self.client.display()
+                        self.client.display("--- EUREUREONG | THE WEREWOLVES ---")
+                        self.client.display("Hai %s!" % (self.client.player_name))
+                        self.client.display("Tugasmu adalah menjadi: %s." % (role))
+
+                    # servers that predate configurable games always have two
+                    self.client.werewolf_count = message.get(protocol.WEREWOLF_COUNT, 2)
 
                     if protocol.FRIEND in message:
                         self.client.friends = message[protocol.FRIEND]
-                        print("Temanmu: %s" % (self.client.friends))
+                        self.client.display("Temanmu: %s" % (self.client.friends))
                     else:
                         self.client.friends = []
 
                     if protocol.TIME in message:
                         self.client.game_time = message[protocol.TIME]
-                        print()
-                        print("Hari ke-%d, Waktu: %s" % (self.client.game_day, self.client.game_time))
+                        self.client.display()
+                        self.client.display("Hari ke-%d, Waktu: %s" % (self.client.game_day, self.client.game_time))
 
                     if protocol.DESCRIPTION in message:
-                        print(message[protocol.DESCRIPTION])
+                        self.client.display(message[protocol.DESCRIPTION])
 
                     self.is_leader_election = True
                     self.client.client_address()
 
                     self.client.vote_number = 0
+                    self.client.notify(method)
 
                 elif method == protocol.METHOD_CHANGE_PHASE:
                     if protocol.TIME in message:
@@ -182,38 +300,40 @@ class Handler:
 
                     if protocol.DAYS in message:
                         self.client.game_day = message[protocol.DAYS]
+                    self._reset_votes()
+                    self._replay_votes()
 
-                    print()
-                    print("Hari ke-%d, Waktu: %s" % (self.client.game_day, self.client.game_time))
+                    self.client.display()
+                    self.client.display("Hari ke-%d, Waktu: %s" % (self.client.game_day, self.client.game_time))
                     if protocol.DESCRIPTION in message:
-                        print(message[protocol.DESCRIPTION])
+                        self.client.display(message[protocol.DESCRIPTION])
 
                     if self.client.game_time == protocol.TIME_DAY:
-                        self.is_leader_election = True
+                        # a KPU with a running lease is announced by the
+                        # server right away, one whose lease ran out renews it
+                        self.client.renew_kpu_id = message.get(protocol.KPU_ID)
+                        if not message.get(protocol.KPU_LEASE):
+                            self.is_leader_election = True
                     self.client.client_address()
 
                     self.client.vote_number = 0
+                    self.client.notify(method)
 
                 elif method == protocol.METHOD_KPU_SELECTED:
+                    self.client.proposer.stop()
                     if protocol.KPU_ID in message:
                         self.client.kpu_id = message[protocol.KPU_ID]
-                        for client in self.client.clients:
-                            if client[protocol.PLAYER_ID] == self.client.kpu_id:
-                                print("Pemain '%s' terpilih menjadi ketua KPU!" % (client[protocol.PLAYER_USERNAME]))
-                                self.client.kpu_address = client[protocol.PLAYER_ADDRESS]
-                                self.client.kpu_port = client[protocol.PLAYER_PORT]
-                                break
+                        self.client.kpu_address = None
+                        self._locate_kpu()
+                    self.client.notify(method)
 
                 elif method == protocol.METHOD_VOTE_NOW:
                     self.client.vote_number += 1
-                    self.vote_count = {}
-                    with self.client.cv:
-                        self.client.cv.notify_all()
+                    self.client.notify(method)
 
                 elif method == protocol.METHOD_GAME_OVER:
                     if protocol.DESCRIPTION in message:
-                        print()
-                        print(message[protocol.DESCRIPTION])
+                        self.client.display()
+                        self.client.display(message[protocol.DESCRIPTION])
 
-                    with self.client.cv:
-                        self.client.cv.notify_all()
+                    self.client.notify(method)
@@ -0,0 +1,224 @@
+import logging
+import random
+import threading
+
+from common import protocol
+from common.rtt import RttEstimator
+
+logger = logging.getLogger(__name__)
+
+
+# the two highest ids propose at once, or the highest alone with the
+# runner-up standing by in case it makes no progress
+DUELING = "dueling"
+DISTINGUISHED = "distinguished"
+ELECTIONS = (DUELING, DISTINGUISHED)
+
+
+class Proposer:
+    """Drives one KPU election as a proposer. Each phase moves on as soon as
+    a majority has answered instead of waiting out a fixed period; a phase
+    that stalls is retried after a timeout that follows the measured round
+    trip time and backs off exponentially, with jitter so that competing
+    proposers drift apart."""
+
+    STANDBY = "standby"
+    PREPARE = "prepare"
+    ACCEPT = "accept"
+    ACCEPTED = "accepted"
+
+    def __init__(self, client, clock, rng=None, election=DUELING):
+        self.client = client
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.rtt = RttEstimator()
+        self.max_backoff = 4
+        self.election = election
+
+        self.lock = threading.RLock()
+        self.seq = 0
+        self.phase = None
+        self.timer = None
+        self.attempt = 0
+
+        self.candidates = []
+        self.proposal_id = None
+        self.peer_count = 0
+        self.quorum = 0
+        self.sent_at = None
+        self.promises = set()
+        self.accepts = set()
+        self.rejects = set()
+
+        # rounds each election took, for the elections this client ran
+        self.rounds = 0
+        self.election_rounds = []
+
+    def start(self, candidates):
+        """Runs for KPU. Candidates are ordered by precedence; in the
+        distinguished mode only the first proposes right away and the
+        others wait for it to stall."""
+        with self.lock:
+            self.candidates = candidates
+            self.attempt = 0
+            self.rounds = 0
+            if self.election == DISTINGUISHED and candidates[0] != self.client.player_id:
+                self.phase = self.STANDBY
+                self._arm(self.standby_timeout())
+            else:
+                self._prepare()
+
+    def renew(self):
+        """Keeps the office for this KPU with an accept round under the
+        proposal that elected it, acceptors have already promised it."""
+        with self.lock:
+            self.candidates = [self.client.player_id]
+            self.attempt = 0
+            self.rounds = 1
+            if self.proposal_id is None:
+                self._prepare()
+            else:
+                self.client.previous_accepted_kpu_id = self.client.player_id
+                self._accept()
+
+    def stop(self):
+        with self.lock:
+            if self.phase is not None and self.phase != self.STANDBY:
+                self.election_rounds.append(self.rounds)
+                logger.info("Election took %d round(s)", self.rounds)
+            self.phase = None
+            self._cancel()
+
+    def on_progress(self):
+        """Another proposer is making progress, keep standing by."""
+        with self.lock:
+            if self.phase == self.STANDBY:
+                self._cancel()
+                self._arm(self.standby_timeout())
+
+    def _peers(self, exclude):
+        for client in self.client.clients:
+            if client[protocol.PLAYER_ID] in exclude:
+                continue
+            yield (client[protocol.PLAYER_ADDRESS], client[protocol.PLAYER_PORT])
+
+    def _prepare(self):
+        self.seq += 1
+        self.rounds += 1
+        self.proposal_id = [self.seq, self.client.player_id]
+        self.phase = self.PREPARE
+        self.promises = set()
+        self.rejects = set()
+        self.client.previous_accepted_kpu_id = self.client.player_id
+
+        peers = list(self._peers((self.client.player_id,)))
+        self.peer_count = len(peers)
+        self.quorum = len(peers) // 2 + 1
+        self.sent_at = self.clock.now()
+        for address in peers:
+            self.client.prepare_proposal(self.proposal_id, address)
+        self._arm()
+
+    def _accept(self):
+        self.phase = self.ACCEPT
+        self.accepts = set()
+        self.rejects = set()
+
+        peers = list(self._peers(self.candidates))
+        self.peer_count = len(peers)
+        self.quorum = len(peers) // 2 + 1
+        self.sent_at = self.clock.now()
+        for address in peers:
+            self.client.accept_proposal(
+                self.proposal_id, self.client.previous_accepted_kpu_id, address)
+        self._arm()
+
+    def _is_current(self, phase, message):
+        if self.phase != phase:
+            return False
+        # peers that predate proposal ids in replies answer the latest round
+        proposal_id = message.get(protocol.PROPOSAL_ID, self.proposal_id)
+        return proposal_id == self.proposal_id
+
+    def _sample(self):
+        self.rtt.sample(self.clock.now() - self.sent_at)
+
+    def _reject(self, address, message):
+        # number the next proposal past anything an acceptor has promised
+        promised_id = message.get(protocol.PROMISED_ID)
+        if isinstance(promised_id, list) and promised_id:
+            self.seq = max(self.seq, promised_id[0])
+
+        # once a majority can no longer be reached retry without waiting
+        # out the timeout
+        self.rejects.add(address)
+        if len(self.rejects) > self.peer_count - self.quorum:
+            self._cancel()
+            self._arm(self.timeout() / 2)
+
+    def on_promise(self, address, message):
+        with self.lock:
+            if not self._is_current(self.PREPARE, message):
+                return
+            self._sample()
+            if message.get(protocol.STATUS) != protocol.STATUS_OK:
+                self._reject(address, message)
+                return
+
+            self.promises.add(address)
+            if protocol.KPU_PREV_ACCEPTED in message:
+                self.client.previous_accepted_kpu_id = message[protocol.KPU_PREV_ACCEPTED]
+
+            if len(self.promises) >= self.quorum:
+                self._cancel()
+                self.attempt = 0
+                self._accept()
+
+    def on_accepted(self, address, message):
+        with self.lock:
+            if not self._is_current(self.ACCEPT, message):
+                return
+            self._sample()
+            if message.get(protocol.STATUS) != protocol.STATUS_OK:
+                self._reject(address, message)
+                return
+
+            self.accepts.add(address)
+            if len(self.accepts) >= self.quorum:
+                # the acceptors told the server, wait for its announcement
+                # and start over if it never comes
+                self._cancel()
+                self.phase = self.ACCEPTED
+                self._arm()
+
+    def timeout(self):
+        backoff = 2 ** min(self.attempt, self.max_backoff)
+        return self.rtt.timeout() * backoff * self.rng.uniform(1, 1.5)
+
+    def standby_timeout(self):
+        # give the distinguished proposer a full round and a retry
+        return 3 * self.rtt.timeout() * self.rng.uniform(1, 1.5)
+
+    def _arm(self, delay=None):
+        if delay is None:
+            delay = self.timeout()
+        self.timer = self.clock.call_later(delay, self._on_timeout, self.proposal_id)
+
+    def _cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def _on_timeout(self, proposal_id):
+        with self.lock:
+            if self.phase is None or proposal_id != self.proposal_id:
+                return
+            if not self.client.keep_running:
+                self.phase = None
+                return
+            if self.phase == self.STANDBY:
+                logger.info("No progress on the election, proposing")
+            else:
+                logger.debug("Proposal %s timed out in %s phase", proposal_id, self.phase)
+                self.attempt += 1
+            self._prepare()
@@ -0,0 +1,169 @@
+from client.client import Client
+from client.paxos import DUELING
+from common import protocol
+
+
+class Player(Client):
+    """A player that follows the game on its own: joins, gets ready, takes
+    part in the KPU election and votes when the server asks. Subclasses
+    choose the name, when to get ready and whom to vote for.
+
+    step() acts once on each game state and returns without waiting, so
+    one thread can drive many players; play() runs it until the game is
+    over."""
+
+    def __init__(self, host, port, room=None, election=DUELING,
+                 reliable=False, loss=0.25, faults=None, **kwargs):
+        super().__init__(host, port, election, reliable, loss, faults, **kwargs)
+
+        self.room = room
+        self.request_timeout = 2
+
+        self.previous_accepted_kpu_id = None
+        self.last_accepted_proposal_id = [0, 0]
+
+        self.player_name = None
+        self.is_game_over = False
+        self.join_request = None
+        self.ready_request = None
+        self.elected_day = None
+        # the vote round this player last voted in, and the roster request
+        # the pending vote waits on
+        self.voted = None
+        self.vote_round = None
+        self.roster_request = None
+        self.roster_deadline = None
+
+    def choose_name(self):
+        """Returns the name to join with, or None to give up."""
+        raise NotImplementedError
+
+    def confirm_ready(self):
+        """Returns True once the player is ready to start."""
+        return True
+
+    def choose_vote(self, candidates):
+        """Returns the id to vote for out of the set of candidates, or None
+        to abstain."""
+        raise NotImplementedError
+
+    def notify(self, event):
+        # requests sent afterwards overwrite the server state
+        if event == protocol.METHOD_GAME_OVER:
+            self.is_game_over = True
+        super().notify(event)
+
+    def step(self):
+        """Acts on the game state and returns whether the game goes on."""
+        if not self.keep_running or self.is_game_over:
+            return False
+
+        if not self.is_joined:
+            self._join()
+        elif self.ready_request is None:
+            if self.confirm_ready():
+                self.ready_request = self.ready()
+
+        if self.server_state == protocol.METHOD_LEADER_ELECTION and self.elected_day != self.game_day:
+            self.elected_day = self.game_day
+            self._leader_election()
+
+        vote_round = (self.game_day, self.game_time, self.vote_number)
+        if self.vote_number and vote_round != self.voted:
+            self._vote(vote_round)
+
+        return self.keep_running and not self.is_game_over
+
+    def play(self):
+        try:
+            while self.step():
+                # the timeout covers a change that came in while stepping
+                with self.cv:
+                    self.cv.wait(self.poll_time)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.close()
+
+    def _join(self):
+        # a refused join asks for another name
+        if self.join_request is not None and not self.join_request.event.is_set():
+            return
+        name = self.choose_name()
+        if name is None:
+            self.close()
+            return
+        self.player_name = name
+        self.join_request = self.join(name, self.room)
+
+    def _leader_election(self):
+        if self.renew_kpu_id is not None:
+            if self.renew_kpu_id == self.player_id:
+                self.proposer.renew()
+            return
+
+        proposer_candidates = [
+            client[protocol.PLAYER_ID] for client in self.clients
+        ]
+        proposer_candidates.sort(reverse=True)
+        proposer_candidates = proposer_candidates[:2]
+
+        if self.player_id in proposer_candidates:
+            self.proposer.start(proposer_candidates)
+
+    def _vote(self, vote_round):
+        # a versioned roster is kept current by the pushes, without them
+        # fetch it first and carry on with the one we have if the server
+        # is slow to answer
+        if self.vote_round != vote_round:
+            self.vote_round = vote_round
+            if protocol.FEATURE_ROSTER_PUSH not in self.features or self.roster_version is None:
+                self.roster_request = self.client_address()
+                self.roster_deadline = self.clock.now() + self.request_timeout
+                return
+        if (self.roster_request is not None and not self.roster_request.event.is_set() and
+                self.clock.now() < self.roster_deadline):
+            return
+
+        self.voted = vote_round
+        self.roster_request = None
+        self.vote()
+
+    def is_alive(self):
+        for client in self.clients:
+            if client[protocol.PLAYER_ID] == self.player_id:
+                return client[protocol.PLAYER_IS_ALIVE]
+        return False
+
+    def is_asleep(self):
+        return self.game_time == protocol.TIME_NIGHT and self.player_role == protocol.ROLE_CIVILIAN
+
+    def vote_candidates(self):
+        """The ids this player may vote for: anyone alive by day, anyone
+        alive but the werewolves at night."""
+        candidates = set()
+        for client in self.clients:
+            if not client[protocol.PLAYER_IS_ALIVE]:
+                continue
+            cid = client[protocol.PLAYER_ID]
+            if self.game_time == protocol.TIME_NIGHT:
+                if cid == self.player_id or client[protocol.PLAYER_USERNAME] in self.friends:
+                    continue
+            candidates.add(cid)
+        return candidates
+
+    def vote(self):
+        if not self.is_alive() or self.is_asleep():
+            return
+
+        kill_id = self.choose_vote(self.vote_candidates())
+        if kill_id is None or not self.keep_running:
+            return
+
+        address = (self.kpu_address, self.kpu_port)
+        if self.game_time == protocol.TIME_DAY:
+            self.vote_civilian(kill_id, address)
+        elif self.game_time == protocol.TIME_NIGHT:
+            self.vote_werewolf(kill_id, address)
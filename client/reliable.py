@@ -0,0 +1,131 @@
+import logging
+import threading
+
+from common import protocol
+from common.rtt import RttEstimator
+
+logger = logging.getLogger(__name__)
+
+
+class Outgoing:
+
+    __slots__ = ("message", "unreliable", "sent_at", "attempts", "timer")
+
+    def __init__(self, message, unreliable):
+        self.message = message
+        self.unreliable = unreliable
+        self.sent_at = None
+        self.attempts = 0
+        self.timer = None
+
+
+class Peer:
+
+    def __init__(self):
+        self.next_seq = 1
+        self.unacked = {}
+        self.rtt = RttEstimator()
+
+        # every sequence number up to floor was delivered, and the ones
+        # above it in received
+        self.floor = 0
+        self.received = set()
+        self.acks = []
+        self.ack_timer = None
+
+
+class ReliableChannel:
+    """Retransmits peer messages until they are acknowledged. Messages get
+    a per-peer sequence number, receivers acknowledge each one selectively
+    and drop duplicates, and senders retransmit after the peer's RTT-based
+    timeout. Messages without a sequence number, from peers that do not
+    run the channel, are passed through untouched. A sender gives up after
+    max_attempts, so once window messages arrived past a gap, the receiver
+    takes the gap as lost and moves on."""
+
+    def __init__(self, connection, clock, max_attempts=8, ack_delay=0.01, window=64):
+        self.connection = connection
+        self.clock = clock
+        self.max_attempts = max_attempts
+        self.ack_delay = ack_delay
+        self.window = window
+
+        self.lock = threading.Lock()
+        self.peers = {}
+
+    def _peer(self, address):
+        peer = self.peers.get(address)
+        if peer is None:
+            peer = self.peers[address] = Peer()
+        return peer
+
+    def send(self, message, address, unreliable=False):
+        with self.lock:
+            peer = self._peer(address)
+            seq = peer.next_seq
+            peer.next_seq += 1
+            message = dict(message)
+            message[protocol.SEQ] = seq
+            outgoing = peer.unacked[seq] = Outgoing(message, unreliable)
+            self._transmit(peer, seq, outgoing, address)
+
+    def _transmit(self, peer, seq, outgoing, address):
+        outgoing.attempts += 1
+        outgoing.sent_at = self.clock.now()
+        timeout = peer.rtt.timeout() * 2 ** (outgoing.attempts - 1)
+        outgoing.timer = self.clock.call_later(timeout, self._retransmit, address, seq)
+        self.connection.transmit(outgoing.message, address, outgoing.unreliable)
+
+    def _retransmit(self, address, seq):
+        with self.lock:
+            peer = self.peers.get(address)
+            outgoing = peer and peer.unacked.get(seq)
+            if outgoing is None:
+                return
+            if outgoing.attempts >= self.max_attempts:
+                del peer.unacked[seq]
+                logger.warning("Giving up on message %d to %s:%d", seq, address[0], address[1])
+                return
+            self._transmit(peer, seq, outgoing, address)
+
+    def receive(self, message, address):
+        """Returns the message to handle, or None if there is nothing to
+        handle: a bare acknowledgement or a duplicate."""
+        with self.lock:
+            peer = self._peer(address)
+
+            for seq in message.pop(protocol.ACK, ()):
+                outgoing = peer.unacked.pop(seq, None)
+                if outgoing is None:
+                    continue
+                outgoing.timer.cancel()
+                # only first transmissions give a sample that is not ambiguous
+                if outgoing.attempts == 1:
+                    peer.rtt.sample(self.clock.now() - outgoing.sent_at)
+
+            seq = message.pop(protocol.SEQ, None)
+            if seq is None:
+                return message or None
+
+            # acknowledge duplicates too, the first ack may have been lost
+            peer.acks.append(seq)
+            if peer.ack_timer is None:
+                peer.ack_timer = self.clock.call_later(self.ack_delay, self._send_acks, address)
+
+            if seq <= peer.floor or seq in peer.received:
+                return None
+            peer.received.add(seq)
+            if len(peer.received) > self.window:
+                peer.floor = min(peer.received) - 1
+            while peer.floor + 1 in peer.received:
+                peer.floor += 1
+                peer.received.remove(peer.floor)
+            return message
+
+    def _send_acks(self, address):
+        with self.lock:
+            peer = self.peers[address]
+            peer.ack_timer = None
+            acks, peer.acks = peer.acks, []
+        if acks:
+            self.connection.transmit({protocol.ACK: acks}, address, True)
@@ -0,0 +1,129 @@
+"""
+Module containing the clock used for protocol timers
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+
+    __slots__ = ("deadline", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Clock:
+    """Monotonic wall clock. Timers run one after another on a single
+    daemon thread, so callbacks should be short and never block."""
+
+    def __init__(self):
+        self.timers = []
+        self.seq = itertools.count()
+        self.cv = threading.Condition()
+        self.thread = None
+        self.closed = False
+
+    def now(self):
+        return time.monotonic()
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.now() + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        """Timers with the same deadline run in the order they were set."""
+        timer = Timer(deadline, callback, args)
+        with self.cv:
+            heapq.heappush(self.timers, (timer.deadline, next(self.seq), timer))
+            if self.thread is None and not self.closed:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cv.notify()
+        return timer
+
+    def close(self):
+        """Stops the timer thread, pending timers never run."""
+        with self.cv:
+            self.closed = True
+            self.timers.clear()
+            self.cv.notify()
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while True:
+                    if self.closed:
+                        return
+                    if not self.timers:
+                        self.cv.wait()
+                        continue
+                    deadline, _, timer = self.timers[0]
+                    delay = deadline - self.now()
+                    if delay <= 0:
+                        heapq.heappop(self.timers)
+                        break
+                    self.cv.wait(delay)
+
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer %r failed", timer.callback)
+
+
+class VirtualClock:
+    """Clock for simulations. Time stands still while callbacks run and
+    jumps to the next timer in between, so a run takes as long as its
+    callbacks and repeats exactly. Nothing runs until run() is called."""
+
+    def __init__(self, start=0.0):
+        self.time = start
+        self.timers = []
+        self.seq = itertools.count()
+        self.stopped = False
+
+    def now(self):
+        return self.time
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.time + delay, callback, *args)
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(max(deadline, self.time), callback, args)
+        heapq.heappush(self.timers, (timer.deadline, next(self.seq), timer))
+        return timer
+
+    def close(self):
+        # shared by everything in the simulation, see stop()
+        pass
+
+    def stop(self):
+        """Makes run() return once the running callback is done."""
+        self.stopped = True
+
+    def run(self, until=None):
+        """Runs the timers in order until stopped, none is left or the next
+        one is due after until. Exceptions in callbacks propagate."""
+        self.stopped = False
+        while self.timers and not self.stopped:
+            deadline, _, timer = self.timers[0]
+            if until is not None and deadline > until:
+                self.time = until
+                return
+            heapq.heappop(self.timers)
+            self.time = deadline
+            if not timer.cancelled:
+                timer.callback(*timer.args)
@@ -0,0 +1,59 @@
+"""
+Module containing the network fault model used to test the game under
+loss, latency and reordering
+"""
+
+import random
+
+
+class FaultModel:
+    """Decides what happens to each outgoing message: dropped, duplicated,
+    delayed or held back so that later messages overtake it. All decisions
+    come from one seeded generator, so a seed replays the same faults.
+
+    Datagrams get every fault. Streams keep their order and never lose
+    data, so they only get latency and jitter."""
+
+    def __init__(self, clock, seed=None, loss=0.0, latency=0.0, jitter=0.0,
+                 duplicate=0.0, reorder=0.0):
+        self.clock = clock
+        self.seed = seed
+        self.rng = random.Random(seed)
+
+        self.loss = loss
+        self.latency = latency
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+
+        self.stream_deadline = 0
+
+    def delay(self):
+        return max(0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+    def datagram(self, send, *args):
+        """Sends a datagram through send(*args), subject to all faults."""
+        if self.loss and self.rng.random() < self.loss:
+            return
+
+        copies = 2 if self.duplicate and self.rng.random() < self.duplicate else 1
+        for _ in range(copies):
+            delay = self.delay()
+            # held back long enough for the next messages to go first
+            if self.reorder and self.rng.random() < self.reorder:
+                delay += self.latency + self.jitter + 0.01
+            if delay > 0:
+                self.clock.call_later(delay, send, *args)
+            else:
+                send(*args)
+
+    def stream(self, send, *args):
+        """Sends data on a stream through send(*args), delayed but never
+        ahead of what was sent before it."""
+        if not (self.latency or self.jitter):
+            send(*args)
+            return
+
+        deadline = max(self.clock.now() + self.delay(), self.stream_deadline)
+        self.stream_deadline = deadline
+        self.clock.call_at(deadline, send, *args)
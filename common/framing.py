@@ -0,0 +1,344 @@
+"""
+Module containing incremental message framing for byte streams
+
+Connections start with newline-terminated JSON text found by brace
+matching. A client may negotiate length-prefixed framing at join, where
+every frame is a 4-byte big-endian payload length followed by the payload
+in the negotiated codec.
+"""
+
+import json
+import re
+import struct
+
+from common import protocol
+
+_START = ord(protocol.PROTOCOL_START)
+_END = ord(protocol.PROTOCOL_END)
+_QUOTE = ord('"')
+
+# only these bytes change the scan state; none of them can appear inside a
+# multi-byte UTF-8 sequence, so the buffer is scanned before decoding
+_SCAN_OBJECT = re.compile(rb'[{}"]')
+_SCAN_STRING = re.compile(rb'["\\]')
+
+_LENGTH = struct.Struct("!I")
+_INT = struct.Struct("!i")
+_PHASE = struct.Struct("!BH")
+
+_TIMES = (protocol.TIME_DAY, protocol.TIME_NIGHT)
+
+# the largest frame a peer may send, a roster of many players is far below
+MAX_FRAME = 1048576
+
+TAG_JSON = 0
+TAG_STATUS_OK = 1
+TAG_VOTE_NOW = 2
+TAG_KPU_SELECTED = 3
+TAG_CHANGE_PHASE = 4
+TAG_ACCEPTED_PROPOSAL = 5
+
+
+class FramingError(ValueError):
+    """The peer sent something that cannot be a frame, the connection is
+    to be closed."""
+
+
+class JsonCodec:
+
+    name = protocol.CODEC_JSON
+
+    def encode(self, message):
+        return json.dumps(message).encode()
+
+    def from_json(self, payload):
+        return payload
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class StructCodec:
+    """Packs the high-frequency game messages into a tag byte and a few
+    fixed-size fields, anything else is sent as tagged JSON."""
+
+    name = protocol.CODEC_STRUCT
+
+    def encode(self, message):
+        method = message.get(protocol.METHOD)
+        size = len(message)
+
+        if method is None:
+            if size == 1 and message.get(protocol.STATUS) == protocol.STATUS_OK:
+                return bytes((TAG_STATUS_OK,))
+
+        elif method == protocol.METHOD_VOTE_NOW:
+            phase = message.get(protocol.PHASE)
+            if size == 2 and phase in _TIMES:
+                return bytes((TAG_VOTE_NOW, _TIMES.index(phase)))
+
+        elif method == protocol.METHOD_KPU_SELECTED:
+            kpu_id = message.get(protocol.KPU_ID)
+            if size == 2 and self._is_int(kpu_id):
+                return bytes((TAG_KPU_SELECTED,)) + _INT.pack(kpu_id)
+
+        elif method == protocol.METHOD_ACCEPTED_PROPOSAL:
+            kpu_id = message.get(protocol.KPU_ID)
+            if (size == 3 and self._is_int(kpu_id) and
+                    message.get(protocol.DESCRIPTION) == protocol.DESC_KPU_SELECTED):
+                return bytes((TAG_ACCEPTED_PROPOSAL,)) + _INT.pack(kpu_id)
+
+        elif method == protocol.METHOD_CHANGE_PHASE:
+            time = message.get(protocol.TIME)
+            days = message.get(protocol.DAYS)
+            description = message.get(protocol.DESCRIPTION)
+            if (size == 4 and time in _TIMES and isinstance(days, int) and
+                    0 <= days <= 0xffff and isinstance(description, str)):
+                return (bytes((TAG_CHANGE_PHASE,)) +
+                        _PHASE.pack(_TIMES.index(time), days) +
+                        description.encode())
+
+        return bytes((TAG_JSON,)) + json.dumps(message).encode()
+
+    def from_json(self, payload):
+        return bytes((TAG_JSON,)) + payload
+
+    def decode(self, payload):
+        tag = payload[0]
+        if tag == TAG_JSON:
+            return json.loads(payload[1:])
+
+        elif tag == TAG_STATUS_OK:
+            return {protocol.STATUS: protocol.STATUS_OK}
+
+        elif tag == TAG_VOTE_NOW:
+            return {
+                protocol.METHOD: protocol.METHOD_VOTE_NOW,
+                protocol.PHASE: _TIMES[payload[1]]
+            }
+
+        elif tag == TAG_KPU_SELECTED:
+            return {
+                protocol.METHOD: protocol.METHOD_KPU_SELECTED,
+                protocol.KPU_ID: _INT.unpack_from(payload, 1)[0]
+            }
+
+        elif tag == TAG_ACCEPTED_PROPOSAL:
+            return {
+                protocol.METHOD: protocol.METHOD_ACCEPTED_PROPOSAL,
+                protocol.KPU_ID: _INT.unpack_from(payload, 1)[0],
+                protocol.DESCRIPTION: protocol.DESC_KPU_SELECTED
+            }
+
+        elif tag == TAG_CHANGE_PHASE:
+            time, days = _PHASE.unpack_from(payload, 1)
+            return {
+                protocol.METHOD: protocol.METHOD_CHANGE_PHASE,
+                protocol.TIME: _TIMES[time],
+                protocol.DAYS: days,
+                protocol.DESCRIPTION: bytes(payload[1+_PHASE.size:]).decode()
+            }
+
+        raise ValueError("Unknown message tag %d" % tag)
+
+    def _is_int(self, value):
+        return isinstance(value, int) and -0x80000000 <= value <= 0x7fffffff
+
+
+CODECS = {
+    protocol.CODEC_JSON: JsonCodec(),
+    protocol.CODEC_STRUCT: StructCodec(),
+}
+
+
+def negotiate(framings, codecs):
+    """Picks the framing and codec for a connection from what the client
+    advertised at join, returns None to keep the legacy format."""
+    if not isinstance(framings, list) or protocol.FRAMING_LENGTH not in framings:
+        return None
+    if isinstance(codecs, list) and protocol.CODEC_STRUCT in codecs:
+        return protocol.FRAMING_LENGTH, protocol.CODEC_STRUCT
+    return protocol.FRAMING_LENGTH, protocol.CODEC_JSON
+
+
+class MessageTemplate:
+    """A message sent to many connections that differs only by a few
+    fields per recipient. The common fields are serialized once per codec
+    and every identical frame is encoded once per wire format."""
+
+    def __init__(self, common):
+        self.common = common
+        self.prefixes = {}
+        self.frames = {}
+
+    def encode(self, framer, extra):
+        suffix = json.dumps(extra).encode()
+        key = (framer.format, suffix)
+        frame = self.frames.get(key)
+        if frame is not None:
+            return frame
+
+        codec = framer.codec
+        prefix = self.prefixes.get(codec.name)
+        if prefix is None:
+            # the common object without its closing brace
+            prefix = codec.from_json(json.dumps(self.common).encode()[:-1])
+            self.prefixes[codec.name] = prefix
+
+        frame = framer.frame(prefix + b", " + suffix[1:])
+        self.frames[key] = frame
+        return frame
+
+
+class Framer:
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.buffer = bytearray()
+        self.max_frame = max_frame
+        self.framing = protocol.FRAMING_JSON
+        self.codec = CODECS[protocol.CODEC_JSON]
+
+        # scan state, kept between feed() calls
+        self._start = 0
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._skip_separator = False
+        # size on the wire of the last frame fed out
+        self.frame_size = 0
+
+    @property
+    def format(self):
+        return self.framing, self.codec.name
+
+    def set_format(self, framing, codec):
+        if framing == protocol.FRAMING_JSON and codec != protocol.CODEC_JSON:
+            raise ValueError("JSON framing only carries the JSON codec")
+        if framing != self.framing:
+            # the frame that negotiated the switch may still be followed by
+            # its newline terminator
+            self._skip_separator = True
+        self.framing = framing
+        self.codec = CODECS[codec]
+
+    def encode(self, message):
+        if isinstance(message, bytes):
+            return message
+
+        if self.framing == protocol.FRAMING_LENGTH:
+            if isinstance(message, str):
+                message = json.loads(message)
+            return self.frame(self.codec.encode(message))
+
+        if not isinstance(message, str):
+            message = json.dumps(message)
+        return self.frame(message.encode())
+
+    def frame(self, payload):
+        if self.framing == protocol.FRAMING_LENGTH:
+            return _LENGTH.pack(len(payload)) + payload
+        return payload + b"\n"
+
+    def feed(self, data):
+        # the format is checked per frame, so a handler may switch it while
+        # the frames that follow in this buffer are still being decoded
+        self.buffer += data
+        while True:
+            if self.framing == protocol.FRAMING_LENGTH:
+                frame = self._next_length_frame()
+                if frame is None:
+                    break
+                self.frame_size = _LENGTH.size + len(frame)
+                yield self.codec.decode(frame)
+            else:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                self.frame_size = len(frame)
+                yield json.loads(frame)
+
+    def _next_length_frame(self):
+        start = self._start
+        if self._skip_separator:
+            while start < len(self.buffer) and self.buffer[start] in b"\r\n ":
+                start += 1
+            if start < len(self.buffer):
+                self._skip_separator = False
+            self._start = start
+
+        end = start + _LENGTH.size
+        if len(self.buffer) >= end:
+            length = _LENGTH.unpack_from(self.buffer, start)[0]
+            if length > self.max_frame:
+                raise FramingError("Frame of %d bytes is larger than %d" % (length, self.max_frame))
+            end += length
+            if len(self.buffer) >= end:
+                self._pos = self._start = end
+                return bytes(self.buffer[start+_LENGTH.size:end])
+
+        self._pos = start
+        self._compact(start)
+        return None
+
+    def _next_frame(self):
+        buffer = self.buffer
+        pos = self._pos
+        while True:
+            if self._depth == 0:
+                # skip separators and garbage up to the next object
+                pos = buffer.find(_START, pos)
+                if pos < 0:
+                    self._pos = self._start = len(buffer)
+                    self._compact(len(buffer))
+                    return None
+                self._start = pos
+                self._depth = 1
+                pos += 1
+
+            elif self._in_string:
+                match = _SCAN_STRING.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                pos = match.start()
+                if buffer[pos] == _QUOTE:
+                    self._in_string = False
+                    pos += 1
+                elif pos + 1 < len(buffer):
+                    # skip the escaped character
+                    pos += 2
+                else:
+                    # escape at the end of the buffer, rescan it later
+                    break
+
+            else:
+                match = _SCAN_OBJECT.search(buffer, pos)
+                if match is None:
+                    pos = len(buffer)
+                    break
+                pos = match.start()
+                char = buffer[pos]
+                pos += 1
+                if char == _QUOTE:
+                    self._in_string = True
+                elif char == _START:
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if self._depth == 0:
+                        frame = bytes(buffer[self._start:pos])
+                        self._pos = self._start = pos
+                        return frame
+
+        # incomplete frame, wait for more data
+        if pos - self._start > self.max_frame:
+            raise FramingError("Frame is larger than %d bytes" % self.max_frame)
+        self._pos = pos
+        self._compact(self._start)
+        return None
+
+    def _compact(self, offset):
+        if offset:
+            del self.buffer[:offset]
+            self._start -= offset
+            self._pos = max(self._pos - offset, 0)
@@ -0,0 +1,137 @@
+"""
+Module containing the logging setup. Records are handed to a queue and
+formatted and written by a background thread, so the I/O loops never wait
+on the terminal.
+"""
+
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+
+LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+
+# fraction of the payloads sent and received that are logged
+payload_rate = 0.0
+
+# arguments of the last configure(), a forked child starts its own listener
+_settings = None
+_listener = None
+
+
+def sample_payload():
+    return payload_rate and random.random() < payload_rate
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+
+    def prepare(self, record):
+        # the arguments may be objects the caller changes right after, such
+        # as a received message, so the message is formatted here; the
+        # layout and any traceback are left to the listener thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record, with the fields passed as extra."""
+
+    SKIP = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.SKIP:
+                data[key] = value
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, default=repr)
+
+
+def add_arguments(parser, level="INFO"):
+    group = parser.add_argument_group("logging")
+    group.add_argument("--log-level", choices=LEVELS, default=level,
+                       help="level of every logger (default: %s)" % level)
+    group.add_argument("--log", action="append", default=[], metavar="MODULE=LEVEL",
+                       help="level of one module, e.g. server.room=DEBUG; repeatable")
+    group.add_argument("--log-payloads", type=float, default=0.0, metavar="RATE",
+                       help="fraction of the messages whose payload is logged at "
+                            "DEBUG (default: 0)")
+    group.add_argument("--log-json", action="store_true",
+                       help="write one JSON object per record")
+
+
+def parse_levels(specs):
+    levels = {}
+    for spec in specs:
+        name, _, level = spec.partition("=")
+        level = level.upper()
+        if not name or level not in LEVELS:
+            raise ValueError("expected MODULE=LEVEL, got %r" % spec)
+        levels[name] = level
+    return levels
+
+
+def configure(level="INFO", levels=None, payloads=0.0, json_format=False):
+    """Routes every record through a queue to a stderr handler running on
+    a listener thread. levels sets the level of single modules."""
+    global payload_rate, _settings, _listener
+    payload_rate = payloads
+    if _settings is None and hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=_configure_child)
+    _settings = (level, levels, payloads, json_format)
+
+    handler = logging.StreamHandler()
+    if json_format:
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    records = queue.SimpleQueue()
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(records)]
+    root.setLevel(level)
+    for name, module_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+    return _listener
+
+
+@atexit.register
+def shutdown():
+    """Writes out the queued records. Processes that leave through
+    os._exit have to call it themselves."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def _configure_child():
+    # the listener thread of the parent does not exist in the child
+    if _settings is not None:
+        configure(*_settings)
+
+
+def configure_from_args(parser, args):
+    try:
+        levels = parse_levels(args.log)
+    except ValueError as e:
+        parser.error(str(e))
+    if not 0 <= args.log_payloads <= 1:
+        parser.error("--log-payloads must be in [0, 1]")
+    return configure(args.log_level, levels, args.log_payloads, args.log_json)
@@ -25,6 +25,9 @@ METHOD_CHANGE_PHASE = "change_phase"
 METHOD_GAME_OVER = "game_over"
 METHOD_VOTE_NOW = "vote_now"
 METHOD_KPU_SELECTED = "kpu_selected"
+METHOD_ROSTER_UPDATE = "roster_update"
+METHOD_PING = "ping"
+METHOD_PONG = "pong"
 
 STATUS = "status"
 STATUS_OK = "ok"
@@ -35,8 +38,14 @@ CLIENTS = "clients"
 DESCRIPTION = "description"
 
 PROPOSAL_ID = "proposal_id"
+REPLY_TO = "reply_to"
+PROMISED_ID = "promised_id"
 KPU_ID = "kpu_id"
 KPU_PREV_ACCEPTED = "previous_accepted"
+KPU_LEASE = "kpu_lease"
+
+SEQ = "seq"
+ACK = "ack"
 
 PLAYER_ID = "player_id"
 PLAYER_IS_ALIVE = "is_alive"
@@ -46,6 +55,24 @@ PLAYER_UDP_ADDRESS = "udp_address"
 PLAYER_UDP_PORT = "udp_port"
 PLAYER_USERNAME = "username"
 
+ROOM = "room"
+ROOM_DEFAULT = "default"
+
+FRAMING = "framing"
+FRAMING_JSON = "json"
+FRAMING_LENGTH = "length"
+CODEC = "codec"
+CODEC_JSON = "json"
+CODEC_STRUCT = "struct"
+
+FEATURES = "features"
+FEATURE_ROSTER_PUSH = "roster_push"
+FEATURE_HEARTBEAT = "heartbeat"
+
+ROSTER_VERSION = "roster_version"
+ROSTER_PREVIOUS_VERSION = "previous_version"
+ROSTER_REMOVED = "removed"
+
 VOTE_STATUS = "vote_status"
 PLAYER_KILLED = "player_killed"
 VOTE_RESULT = "vote_result"
@@ -58,6 +85,7 @@ ROLE = "role"
 ROLE_WEREWOLF = "werewolf"
 ROLE_CIVILIAN = "civilian"
 FRIEND = "friend"
+WEREWOLF_COUNT = "werewolf_count"
 DAYS = "days"
 WINNER = "winner"
 
@@ -76,6 +104,7 @@ Hingga suatu hari muncullah seseorang yang merubah segalanya. Kejahatan yang ber
 Siang ini, warga desa mengetahui kabar bahwa terdapat beberapa werewolf yang sedang bersembunyi ditengah desa mereka.
 Untuk itu, warga desa melakukan pemilihan untuk membunuh orang yang diduga keras sebagai werewolf dalam penyamaran."""
 DESC_CLIENT_LIST = "List of clients retrieved."
+DESC_NOT_MODIFIED = "List of clients not modified."
 DESC_ACCEPTED = "accepted"
 DESC_REJECTED = "rejected"
 DESC_KPU_SELECTED = "KPU is selected."
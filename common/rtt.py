@@ -0,0 +1,25 @@
+class RttEstimator:
+    """Smoothed round-trip time and its variance, updated the way TCP does
+    (RFC 6298), giving a retransmission timeout that follows the network."""
+
+    def __init__(self, initial=1.0, minimum=0.05, maximum=5.0):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.initial = initial
+
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.initial
+        rto = self.srtt + 4 * self.rttvar
+        return min(max(rto, self.minimum), self.maximum)
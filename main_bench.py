@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+
+import argparse
+import fnmatch
+import os
+import sys
+
+from bench import runner
+from bench.cases import CASES
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "baseline.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Times the hot paths of the server and the client and "
+                    "compares them against a baseline. Exits with 1 when a "
+                    "case got slower than the threshold allows.")
+    parser.add_argument("cases", nargs="*", metavar="CASE",
+                        help="cases to run, shell patterns like 'split.*' "
+                             "(default: all)")
+    parser.add_argument("--list", "-l", action="store_true",
+                        help="list the cases and exit")
+    parser.add_argument("--repeat", "-r", type=int, default=5,
+                        help="timings per case, the best one counts (default: 5)")
+    parser.add_argument("--output", "-o", type=str, default=None,
+                        help="write the results as JSON to this file")
+    parser.add_argument("--baseline", "-b", type=str, default=BASELINE,
+                        help="results to compare against (default: bench/baseline.json)")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline instead of "
+                             "comparing against it")
+    parser.add_argument("--threshold", "-t", type=float, default=0.25,
+                        help="slowdown that counts as a regression (default: 0.25)")
+    args = parser.parse_args()
+
+    if args.list:
+        for name in CASES:
+            print(name)
+        return 0
+    if args.repeat < 1:
+        parser.error("--repeat must be positive")
+
+    names = None
+    if args.cases:
+        names = [
+            name for name in CASES
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in args.cases)
+        ]
+        if not names:
+            parser.error("no case matches %s" % " ".join(args.cases))
+
+    baseline = None
+    if not args.save:
+        if not os.path.exists(args.baseline):
+            # comparing against nothing would pass every run
+            parser.error("no baseline at %s, record one with --save" % args.baseline)
+        baseline = runner.load(args.baseline)
+
+    def progress(name, result):
+        print("%-30s %10s" % (name, runner.format_ns(result["ns"])), flush=True)
+
+    report = runner.run(names, args.repeat, progress)
+    if args.output:
+        runner.save(report, args.output)
+    if args.save:
+        runner.save(report, args.baseline)
+        print("baseline saved to %s" % args.baseline)
+        return 0
+
+    print()
+    print("against the baseline of %s (%s)" % (baseline["time"], baseline["python"]))
+    regressed = 0
+    for name, ns, base_ns, ratio, is_regression in runner.compare(report, baseline, args.threshold):
+        print("%-30s %10s %10s %+7.1f%%%s" % (
+            name, runner.format_ns(ns), runner.format_ns(base_ns), (ratio - 1) * 100,
+            "  REGRESSION" if is_regression else ""))
+        regressed += is_regression
+    if regressed:
+        print("%d case(s) slower by more than %d%%" % (regressed, args.threshold * 100))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import random
+import threading
+import time
+
+from common import log
+from client import paxos
+from client.bot import Bot, BotGame, STRATEGIES, report
+
+
+def close(game):
+    game.close(time.monotonic())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays many games with bots against a server and reports "
+                    "its throughput and latencies.")
+    parser.add_argument("host", type=str, help="server host")
+    parser.add_argument("port", type=int, help="server port")
+    parser.add_argument("--bots", "-n", type=int, default=6,
+                        help="bots in play at once, split evenly across the games")
+    parser.add_argument("--games", "-m", type=int, default=1,
+                        help="games in play at once")
+    parser.add_argument("--count", "-c", type=int, default=None,
+                        help="games to play in total, a new one starts whenever "
+                             "one ends (default: --games)")
+    parser.add_argument("--min-player", type=int, default=6,
+                        help="players the server needs to start a game, as "
+                             "given to main_server.py (default: 6)")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="random",
+                        help="how the bots vote (default: random)")
+    parser.add_argument("--election", choices=paxos.ELECTIONS, default=paxos.DUELING,
+                        help="KPU election run by the bots")
+    parser.add_argument("--reliable", action="store_true",
+                        help="acknowledge and retransmit messages between bots")
+    parser.add_argument("--loss", type=float, default=0.25,
+                        help="rate at which election messages are dropped "
+                             "(default: 0.25)")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds after which a game is given up")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for the votes of the bots")
+    log.add_arguments(parser, "WARNING")
+    args = parser.parse_args()
+    log.configure_from_args(parser, args)
+
+    if args.count is None:
+        args.count = args.games
+    if args.games < 1 or args.count < 1:
+        parser.error("--games and --count must be positive")
+    if args.min_player < 3:
+        parser.error("--min-player must be at least 3")
+    if args.bots < args.min_player * args.games:
+        parser.error("need at least --min-player (%d) bots per game" % args.min_player)
+    if not 0 <= args.loss < 1:
+        parser.error("--loss must be in [0, 1)")
+
+    rng = random.Random(args.seed)
+    # every bot wakes the driver loop when its game moves on
+    cv = threading.Condition()
+
+    def new_game(number):
+        room = "load-%d-%d" % (os.getpid(), number)
+        size = args.bots // args.games + (number % args.games < args.bots % args.games)
+        bots = []
+        for i in range(size):
+            strategy = STRATEGIES[args.strategy](random.Random(rng.random()))
+            bot = Bot(args.host, args.port, "bot-%d-%d" % (number, i), room, strategy,
+                      election=args.election, reliable=args.reliable, loss=args.loss)
+            bot.hold = True
+            bot.cv = cv
+            bots.append(bot)
+        return BotGame(room, bots, time.monotonic())
+
+    started = time.monotonic()
+    running = []
+    games = []
+    try:
+        while running or len(games) < args.count:
+            while len(running) < args.games and len(games) < args.count:
+                game = new_game(len(games))
+                running.append(game)
+                games.append(game)
+
+            for game in list(running):
+                timed_out = time.monotonic() - game.started > args.timeout
+                if not game.step() or timed_out:
+                    running.remove(game)
+                    # closing waits for the bot threads, keep it off this loop
+                    for bot in game.bots:
+                        bot.keep_running = False
+                    threading.Thread(target=close, args=(game,)).start()
+
+            with cv:
+                cv.wait(0.05)
+
+    except KeyboardInterrupt:
+        for game in running:
+            close(game)
+
+    report(games, time.monotonic() - started)
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,111 @@
 
 import argparse
 
+from common import log
 from server.server import Server
+from server.aio import AsyncServer
+from server.outbox import POLICIES
+from server.reactor import ReactorServer
+from server.worker import Supervisor
+
+ENGINES = {
+    "thread": Server,
+    "asyncio": AsyncServer,
+    "reactor": ReactorServer,
+}
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("port", type=int, help="port to bind")
+    parser.add_argument("--engine", "-e", choices=sorted(ENGINES), default="thread",
+                        help="connection engine: thread-per-connection, asyncio or "
+                             "single-threaded selectors reactor")
+    parser.add_argument("--workers", "-w", type=int, default=0,
+                        help="number of worker processes, rooms are spread "
+                             "across them (default: serve in this process)")
+    parser.add_argument("--min-player", type=int, default=6,
+                        help="players needed to start a game")
+    parser.add_argument("--max-player", type=int, default=8,
+                        help="players allowed in one room")
+    parser.add_argument("--werewolves", type=int, default=2,
+                        help="werewolves per game")
+    parser.add_argument("--werewolf-ratio", type=float, default=None,
+                        help="werewolves per player, overrides --werewolves "
+                             "so large games scale their werewolf count")
+    parser.add_argument("--kpu-lease", type=int, default=0,
+                        help="days the KPU keeps the office before it has to "
+                             "renew it (default: elect a new KPU every day)")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics over HTTP on this local "
+                             "port; with workers, worker N uses the port plus N")
+    parser.add_argument("--profile-rate", type=float, default=0,
+                        help="fraction of the messages to run under cProfile; "
+                             "SIGUSR2 toggles profiling, SIGUSR1 dumps the stats")
+    parser.add_argument("--profile-dir", type=str, default=None,
+                        help="directory SIGUSR1 dumps the stats into, as "
+                             "eureureong-<pid>.prof (default: the temporary directory)")
+    parser.add_argument("--outbox-bytes", type=int, default=262144,
+                        help="bytes queued for a client that reads too slowly "
+                             "before its overflow policy applies (default: 262144)")
+    parser.add_argument("--outbox-messages", type=int, default=256,
+                        help="messages queued for a slow client before its "
+                             "overflow policy applies (default: 256)")
+    parser.add_argument("--slow-clients", choices=POLICIES, default=POLICIES[0],
+                        help="on overflow, coalesce drops queued state updates "
+                             "that a newer one replaces and disconnects the "
+                             "client if that is not enough; disconnect does so "
+                             "at once (default: %s)" % POLICIES[0])
+    parser.add_argument("--heartbeat-interval", type=float, default=10,
+                        help="seconds of silence after which a client that "
+                             "announced heartbeats is pinged (default: 10)")
+    parser.add_argument("--idle-timeout", type=float, default=30,
+                        help="seconds of silence after which such a client "
+                             "leaves its room; other clients get TCP keepalive "
+                             "probes after as long; 0 turns both off (default: 30)")
+    log.add_arguments(parser)
     args = parser.parse_args()
+    log.configure_from_args(parser, args)
+
+    if not 3 <= args.min_player <= args.max_player:
+        parser.error("need 3 <= --min-player <= --max-player")
+    if args.kpu_lease < 0:
+        parser.error("--kpu-lease cannot be negative")
+    if not 0 <= args.profile_rate <= 1:
+        parser.error("--profile-rate must be in [0, 1]")
+    if args.outbox_bytes < 1 or args.outbox_messages < 1:
+        parser.error("--outbox-bytes and --outbox-messages must be positive")
+    if args.idle_timeout < 0 or (args.idle_timeout and not 0 < args.heartbeat_interval < args.idle_timeout):
+        parser.error("need 0 < --heartbeat-interval < --idle-timeout")
+    rules = {
+        "min_player": args.min_player,
+        "max_player": args.max_player,
+        "werewolves": args.werewolves,
+        "werewolf_ratio": args.werewolf_ratio,
+        "kpu_lease": args.kpu_lease,
+    }
+    outbox_limits = {
+        "max_bytes": args.outbox_bytes,
+        "max_messages": args.outbox_messages,
+        "policy": args.slow_clients,
+    }
 
-    Server(port=args.port).serve_forever()
+    engine = ENGINES[args.engine]
+    if args.workers > 0:
+        Supervisor(port=args.port, workers=args.workers, engine=engine,
+                   rules=rules, metrics_port=args.metrics_port,
+                   profile_rate=args.profile_rate,
+                   outbox_limits=outbox_limits,
+                   heartbeat_interval=args.heartbeat_interval,
+                   idle_timeout=args.idle_timeout,
+                   profile_dir=args.profile_dir).serve_forever()
+    else:
+        engine(port=args.port, rules=rules, metrics_port=args.metrics_port,
+               profile_rate=args.profile_rate,
+               outbox_limits=outbox_limits,
+               heartbeat_interval=args.heartbeat_interval,
+               idle_timeout=args.idle_timeout,
+               profile_dir=args.profile_dir).serve_forever()
 
 if __name__ == '__main__':
     main()
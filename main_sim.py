@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+import argparse
+import time
+import zlib
+
+from common import log
+from client import paxos
+from client.bot import STRATEGIES, report
+from sim.game import play
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Plays bot games against an in-process server on a virtual "
+                    "clock. Game N uses seed SEED+N, so any game can be replayed "
+                    "with --seed and --games 1.")
+    parser.add_argument("--games", "-n", type=int, default=100,
+                        help="games to play (default: 100)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of the first game (default: 0)")
+    parser.add_argument("--players", "-p", type=int, default=6,
+                        help="bots per game (default: 6)")
+    parser.add_argument("--strategy", choices=sorted(STRATEGIES), default="random",
+                        help="how the bots vote (default: random)")
+    parser.add_argument("--election", choices=paxos.ELECTIONS, default=paxos.DUELING,
+                        help="KPU election run by the bots")
+    parser.add_argument("--reliable", action="store_true",
+                        help="acknowledge and retransmit messages between bots")
+    parser.add_argument("--loss", type=float, default=0.25,
+                        help="rate at which election messages are dropped "
+                             "(default: 0.25)")
+    parser.add_argument("--kpu-lease", type=int, default=0,
+                        help="days the KPU keeps the office, see main_server.py")
+    parser.add_argument("--werewolves", type=int, default=2,
+                        help="werewolves per game")
+    parser.add_argument("--timeout", type=float, default=3600,
+                        help="virtual seconds after which a game is given up")
+    parser.add_argument("--verbose", "-v", action="store_true",
+                        help="print the seed, days, virtual duration and checksum "
+                             "of every game")
+    faults = parser.add_argument_group("network faults", "injected on everything the bots send")
+    faults.add_argument("--latency", type=float, default=0.001,
+                        help="seconds every message takes (default: 0.001)")
+    faults.add_argument("--net-loss", type=float, default=0.0,
+                        help="rate at which any message to a player is dropped")
+    faults.add_argument("--jitter", type=float, default=0.0,
+                        help="seconds the latency of a player's messages varies by")
+    faults.add_argument("--duplicate", type=float, default=0.0,
+                        help="rate at which messages to players are sent twice")
+    faults.add_argument("--reorder", type=float, default=0.0,
+                        help="rate at which messages to players are held back "
+                             "behind later ones")
+    # a long run logs every expected retransmission failure otherwise
+    log.add_arguments(parser, "ERROR")
+    args = parser.parse_args()
+    log.configure_from_args(parser, args)
+
+    if args.games < 1:
+        parser.error("--games must be positive")
+    if not 3 <= args.players <= 8:
+        parser.error("--players must be in [3, 8]")
+    for name in ("loss", "net_loss", "duplicate", "reorder"):
+        if not 0 <= getattr(args, name) < 1:
+            parser.error("--%s must be in [0, 1)" % name.replace("_", "-"))
+    if args.latency < 0 or args.jitter < 0:
+        parser.error("--latency and --jitter cannot be negative")
+
+    rules = {
+        "min_player": min(args.players, 6),
+        "werewolves": args.werewolves,
+        "kpu_lease": args.kpu_lease,
+    }
+    faults = {
+        "loss": args.net_loss,
+        "jitter": args.jitter,
+        "duplicate": args.duplicate,
+        "reorder": args.reorder,
+    }
+
+    started = time.monotonic()
+    games = []
+    digest = 0
+    try:
+        for seed in range(args.seed, args.seed + args.games):
+            game = play(seed, args.players, args.strategy, rules, args.latency, args.timeout,
+                        faults, election=args.election, reliable=args.reliable, loss=args.loss)
+            games.append(game)
+            digest = zlib.crc32(game.digest.to_bytes(4, "big"), digest)
+            if args.verbose or not game.completed:
+                print("seed %d: %s after %d day(s), %.3fs, checksum %08x" % (
+                    seed, "over" if game.completed else "stuck", game.days,
+                    game.finished, game.digest))
+
+    except KeyboardInterrupt:
+        pass
+
+    report(games, time.monotonic() - started)
+    print("timings are in virtual time, checksum of the run: %08x" % digest)
+
+if __name__ == "__main__":
+    main()
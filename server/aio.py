@@ -0,0 +1,213 @@
+import asyncio
+import logging
+import time
+
+from common import log
+from common.framing import Framer, FramingError
+from server.server import Server, set_keepalive
+from server.handler import Handler
+from server.outbox import Outbox, enqueue
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncServer(Server):
+
+    def __init__(self, host='', port=9999, channel=None, rules=None, metrics_port=None,
+                 profile_rate=0, outbox_limits=None, heartbeat_interval=10, idle_timeout=30,
+                 profile_dir=None):
+        super().__init__(host, port, channel, rules, metrics_port, profile_rate, outbox_limits,
+                         heartbeat_interval, idle_timeout, profile_dir)
+
+        self.loop = None
+        self.stopped = None
+        # the task running each connection
+        self.connections = {}
+
+    def serve_forever(self):
+        try:
+            asyncio.run(self._serve())
+
+        except KeyboardInterrupt:
+            logger.info("Terminated by user")
+
+        finally:
+            self.keep_running = False
+            self.socket.close()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        if not self.keep_running:
+            return
+
+        # without heartbeats nothing is due between reads
+        sweeper = None
+        if self.idle_timeout:
+            sweeper = asyncio.ensure_future(self._sweep())
+
+        if self.channel is None:
+            server = await asyncio.start_server(self._accept, sock=self.socket)
+            logger.info("Listening to client connections on port %d", self.port)
+            async with server:
+                await self.stopped.wait()
+        else:
+            self.socket.setblocking(False)
+            self.loop.add_reader(self.socket, self._handoff)
+            logger.info("Waiting for connections from the supervisor")
+            await self.stopped.wait()
+            self.loop.remove_reader(self.socket)
+
+        if sweeper is not None:
+            sweeper.cancel()
+        # let every connection run its leave handler before the loop closes
+        if self.connections:
+            await asyncio.gather(*self.connections, return_exceptions=True)
+
+    async def _sweep(self):
+        # one timer checks every quiet client, the connections only wake
+        # up for their own reads
+        while True:
+            await asyncio.sleep(self.timeout)
+            now = time.monotonic()
+            for connection in list(self.connections.values()):
+                if connection.handler.check_idle(now):
+                    connection.abort()
+
+    def _handoff(self):
+        try:
+            accepted = self.accept_client()
+        except BlockingIOError:
+            return
+        if accepted is None:
+            logger.info("Supervisor is gone, exiting")
+            self.close()
+            return
+
+        client_socket, client_addr, data = accepted
+        self.loop.create_task(self._adopt(client_socket, data))
+
+    async def _adopt(self, client_socket, data):
+        reader, writer = await asyncio.open_connection(sock=client_socket)
+        await self._accept(reader, writer, data)
+
+    async def _accept(self, reader, writer, data=b""):
+        client_addr = writer.get_extra_info('peername')
+        logger.debug("Connection from %s", client_addr)
+
+        connection = AsyncConnection(self, reader, writer, data)
+        task = asyncio.current_task()
+        self.connections[task] = connection
+        try:
+            await connection.run()
+        finally:
+            del self.connections[task]
+
+    def close(self):
+        self.keep_running = False
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+
+
+class AsyncConnection:
+
+    def __init__(self, server, reader, writer, data=b""):
+        self.buf_size = 2048
+
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info('peername')
+        self.data = data
+        self.handler = Handler(server, self)
+        self.framer = Framer()
+        set_keepalive(writer.get_extra_info('socket'), server.idle_timeout, server.heartbeat_interval)
+
+        # the transport takes up to write_limit bytes, the rest waits in the
+        # bounded outbox until it drains
+        self.outbox = Outbox(**server.outbox_limits)
+        self.write_limit = 65536
+        self.writer.transport.set_write_buffer_limits(self.write_limit)
+        self.flushing = None
+
+    async def run(self):
+        read = asyncio.ensure_future(self.reader.read(self.buf_size))
+        stopped = asyncio.ensure_future(self.server.stopped.wait())
+        try:
+            # bytes the supervisor already read while routing this connection
+            self.handler.feed(self.data)
+
+            while self.server.keep_running:
+                await asyncio.wait([read, stopped], return_when=asyncio.FIRST_COMPLETED)
+                if stopped.done():
+                    break
+
+                # receive the packet
+                message = read.result()
+
+                # client is disconnected
+                if not message:
+                    logger.debug("Client %s disconnected", self.addr)
+                    break
+
+                read = asyncio.ensure_future(self.reader.read(self.buf_size))
+
+                if log.sample_payload():
+                    logger.debug("Received %d bytes from %s: %r", len(message), self.addr, message)
+
+                # handle every complete frame, keep the rest for next read
+                self.handler.feed(message)
+
+        except ConnectionError:
+            logger.debug("Client %s disconnected", self.addr)
+
+        except FramingError as e:
+            logger.warning("Dropping client %s: %s", self.addr, e)
+
+        except Exception:
+            logger.exception("Dropping client %s", self.addr)
+
+        finally:
+            read.cancel()
+            stopped.cancel()
+            if self.flushing is not None:
+                self.flushing.cancel()
+
+        self.handler.close()
+        self.writer.close()
+
+    def send(self, message, method=None):
+        if self.writer.is_closing():
+            return
+        data = self.framer.encode(message)
+        if log.sample_payload():
+            logger.debug("Sending to %s: %r", self.addr, data)
+
+        if not self.outbox and self._can_write():
+            self.writer.write(data)
+        elif not enqueue(self, data, method):
+            return
+        elif self.flushing is None:
+            self.flushing = asyncio.ensure_future(self._flush())
+        hooks = self.server.hooks
+        hooks is not None and hooks.sent(self.handler, message, len(data), method)
+
+    def _can_write(self):
+        return self.writer.transport.get_write_buffer_size() <= self.write_limit
+
+    async def _flush(self):
+        try:
+            while self.outbox and not self.writer.is_closing():
+                # returns once the transport went below its low-water mark
+                await self.writer.drain()
+                while self.outbox and self._can_write():
+                    frame = self.outbox.frames[0]
+                    self.writer.write(frame)
+                    self.outbox.consume(len(frame))
+        except ConnectionError:
+            self.outbox.clear()
+        finally:
+            self.flushing = None
+
+    def abort(self):
+        self.writer.transport.abort()
@@ -1,93 +1,113 @@
-import threading
-import select
-import json
+import logging
+import time
 
 from common import protocol
+from common.framing import negotiate
+
+logger = logging.getLogger(__name__)
 
 
 class Handler:
 
     def __init__(self, server, connection):
-        self.verbose = True
         self.server = server
         self.connection = connection
 
+        self.room = None
         self.player_id = None
         self.username = None
 
-    def _split(self, messages):
-        last_messages = []
-        idx = messages.find(protocol.PROTOCOL_START)
-        while idx >= 0:
-            level = 1
-            for i in range(idx+1, len(messages)):
-                if messages[i] == protocol.PROTOCOL_START:
-                    level += 1
-                elif messages[i] == protocol.PROTOCOL_END:
-                    level -= 1
-                    if level == 0:
-                        idx = i
-                        break
-            # split message from PROTOCOL_END marker
-            message = messages[:idx+1]
-            messages = messages[idx+1:]
-
-            # try to load as json
-            message = json.loads(message)
-            last_messages.append(message)
-
-            # continue find PROTOCOL_END
-            idx = messages.find(protocol.PROTOCOL_END)
-
-        return last_messages
-
-    def handle(self, messages):
-        messages = self._split(messages)
-        for message in messages:
-            if protocol.METHOD not in message:
-                continue
-
-            # call corresponding method, if exists
-            method = message[protocol.METHOD]
-            handle_method = getattr(self, "handle_" + method, None)
-            if callable(handle_method):
-                handle_method(message)
-            else:
-                self.verbose and print(
-                    "Error: Method '%s' not implemented" % method)
+        # the request being handled
+        self.method = None
 
-    def handle_join(self, message):
+        # a client that announced heartbeats is pinged when quiet and
+        # dropped when it stays silent past the idle deadline
+        self.heartbeat = False
+        self.last_seen = time.monotonic()
+        self.ping_sent = 0
+        self.server.hooks is not None and self.server.hooks.opened(self)
+
+    def close(self):
+        """The connection is gone, leave the room if still in one."""
         if self.player_id is not None:
-            data = json.dumps({
-                protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_ALREADY_JOINED
-            })
-            self.connection.send(data)
+            # the leave reply answers no request of the client
+            self.method = protocol.METHOD_LEAVE
+            self.handle_leave()
+        self.server.hooks is not None and self.server.hooks.closed(self)
+
+    def feed(self, data):
+        """Handles every complete frame in data, the rest is kept until
+        more data arrives."""
+        self.last_seen = time.monotonic()
+        hooks = self.server.hooks
+        if hooks is None:
+            for message in self.connection.framer.feed(data):
+                self.handle(message)
             return
 
-        elif self.server.is_playing:
-            data = json.dumps({
-                protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_GAME_IS_PLAYING
-            })
-            self.connection.send(data)
+        start = time.perf_counter()
+        for message in self.connection.framer.feed(data):
+            self.handle(message)
+        hooks.received(self, len(data), time.perf_counter() - start)
+
+    def handle(self, message):
+        if protocol.METHOD not in message:
             return
 
-        elif self.server.player_count >= self.server.MAX_PLAYER:
-            data = json.dumps({
+        # call corresponding method, if exists
+        method = message[protocol.METHOD]
+        handle_method = getattr(self, "handle_" + method, None)
+        if not callable(handle_method):
+            method, handle_method = "unknown", self._handle_unknown
+        self.method = method
+
+        hooks = self.server.hooks
+        if hooks is None:
+            handle_method(message)
+        else:
+            hooks.dispatch(self, method, handle_method, message)
+
+    def check_idle(self, now):
+        """Pings the client when it has been quiet for a heartbeat interval,
+        returns True once it has been silent past the idle deadline and is
+        to be disconnected. Only for clients that announced heartbeats,
+        the others may well sit quiet for a whole phase."""
+        if not self.heartbeat or not self.server.idle_timeout:
+            return False
+
+        idle = now - self.last_seen
+        if idle >= self.server.idle_timeout:
+            logger.info("Evicting player '%s', silent for %.0fs", self.username, idle)
+            return True
+
+        interval = self.server.heartbeat_interval
+        if now - max(self.ping_sent, self.last_seen) >= interval:
+            self.ping_sent = now
+            data = {
+                protocol.METHOD: protocol.METHOD_PING
+            }
+            self.connection.send(data, protocol.METHOD_PING)
+        return False
+
+    def _handle_unknown(self, message):
+        logger.warning("Method '%s' not implemented", message[protocol.METHOD])
+
+    def handle_join(self, message):
+        if self.player_id is not None:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_SERVER_IS_FULL
-            })
+                protocol.DESCRIPTION: protocol.DESC_ALREADY_JOINED
+            }
             self.connection.send(data)
             return
 
         elif (protocol.PLAYER_USERNAME not in message or
                 protocol.PLAYER_UDP_ADDRESS not in message or
                 protocol.PLAYER_UDP_PORT not in message):
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
@@ -95,237 +115,268 @@ class Handler:
             username = str(message[protocol.PLAYER_USERNAME]).strip()
             address = str(message[protocol.PLAYER_UDP_ADDRESS]).strip()
             port = int(message[protocol.PLAYER_UDP_PORT])
-        except ValueError:
-            data = json.dumps({
+            room_name = str(message.get(protocol.ROOM, protocol.ROOM_DEFAULT)).strip()
+            features = [str(feature) for feature in message.get(protocol.FEATURES, [])]
+        except (ValueError, TypeError):
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
-        if username in self.server.usernames:
-            data = json.dumps({
+        if not username:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_USERNAME_EXISTS
-            })
+                protocol.DESCRIPTION: protocol.DESC_USERNAME_BLANK
+            }
             self.connection.send(data)
             return
-        elif not username:
-            data = json.dumps({
+
+        description = None
+        while True:
+            room = self.server.get_room(room_name or protocol.ROOM_DEFAULT)
+            with room.lock:
+                # room was released between lookup and locking, look it up again
+                if room.is_closed:
+                    continue
+
+                if room.is_playing:
+                    description = protocol.DESC_GAME_IS_PLAYING
+                elif room.player_count >= room.MAX_PLAYER:
+                    description = protocol.DESC_SERVER_IS_FULL
+                elif username in room.usernames:
+                    description = protocol.DESC_USERNAME_EXISTS
+                else:
+                    player = room.add_player(
+                        username, self.connection, address, port, features)
+
+                    self.room = room
+                    self.player_id = player.id
+                    self.username = username
+                    self.heartbeat = protocol.FEATURE_HEARTBEAT in features
+            break
+
+        if description is not None:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_USERNAME_BLANK
-            })
+                protocol.DESCRIPTION: description
+            }
             self.connection.send(data)
+            self.server.release_room(room)
             return
 
-        with self.server.lock:
-            i = self.server.id_taken.index(False)
-
-            self.player_id = i
-            self.username = username
-
-            self.server.player_count += 1
-            self.server.ids.append(i)
-            self.server.usernames.add(username)
-            self.server.id_taken[i] = True
-            self.server.is_ready[i] = False
-            self.server.is_alive[i] = True
-            self.server.is_werewolf[i] = False
-            self.server.player_name[i] = username
-            self.server.player_connection[i] = self.connection
-            self.server.player_address[i] = address
-            self.server.player_port[i] = port
-
-        data = json.dumps({
+        data = {
             protocol.STATUS: protocol.STATUS_OK,
             protocol.PLAYER_ID: self.player_id
-        })
-        self.connection.send(data)
+        }
+        negotiated = negotiate(
+            message.get(protocol.FRAMING), message.get(protocol.CODEC))
+        if negotiated is not None:
+            data[protocol.FRAMING], data[protocol.CODEC] = negotiated
+
+        # the reply still goes out in the legacy format, the room lock keeps
+        # broadcasts from slipping in before the switch
+        with room.lock:
+            self.connection.send(data)
+            if negotiated is not None:
+                self.connection.framer.set_format(*negotiated)
 
     def handle_leave(self, message=None):
         if self.player_id is None:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_NOT_JOINED
-            })
+            }
             self.connection.send(data)
             return
 
-        with self.server.lock:
-            self.server.player_count -= 1
-            if self.player_id in self.server.ids:
-                self.server.ids.remove(self.player_id)
-            if self.username in self.server.usernames:
-                self.server.usernames.remove(self.username)
-            self.server.id_taken[self.player_id] = False
-            self.server.is_ready[self.player_id] = False
-            self.server.is_alive[self.player_id] = False
-            self.server.is_werewolf[self.player_id] = False
-            self.server.player_name[self.player_id] = None
-            self.server.player_connection[self.player_id] = None
+        room = self.room
+        with room.lock:
+            room.remove_player(self.player_id)
+            room.push_roster()
 
+            self.room = None
             self.username = None
             self.player_id = None
-        data = json.dumps({
+        self.server.release_room(room)
+
+        data = {
             protocol.STATUS: protocol.STATUS_OK
-        })
+        }
         self.connection.send(data)
 
+    def handle_pong(self, message=None):
+        # every frame counts as a sign of life, see feed(); nothing to answer
+        pass
+
     def handle_ready(self, message=None):
         if self.player_id is None:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_NOT_JOINED
-            })
+            }
             self.connection.send(data)
             return
-        elif self.server.is_playing:
-            data = json.dumps({
+        elif self.room.is_playing:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_GAME_IS_PLAYING
-            })
+            }
             self.connection.send(data)
             return
-        elif self.server.is_ready[self.player_id]:
-            data = json.dumps({
+        elif self.room.players[self.player_id].is_ready:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_WERE_READY
-            })
+            }
             self.connection.send(data)
             return
 
-        with self.server.lock:
-            self.server.is_ready[self.player_id] = True
-            data = json.dumps({
+        room = self.room
+        with room.lock:
+            room.set_ready(self.player_id)
+            data = {
                 protocol.STATUS: protocol.STATUS_OK,
                 protocol.DESCRIPTION: protocol.DESC_WAIT_TO_START
-            })
+            }
             self.connection.send(data)
 
-            if (self.server.player_count >= self.server.MIN_PLAYER and
-                    self.server.player_count == self.server.is_ready.count(True)):
-                self.server.start_game()
+            if (room.player_count >= room.MIN_PLAYER and
+                    room.player_count == room.ready_count):
+                room.start_game()
 
     def handle_client_address(self, message=None):
-        with self.server.lock:
-            clients = [{
-                protocol.PLAYER_ID: i,
-                protocol.PLAYER_IS_ALIVE: 1 if self.server.is_alive[i] else 0,
-                protocol.PLAYER_ADDRESS: self.server.player_address[i],
-                protocol.PLAYER_PORT: self.server.player_port[i],
-                protocol.PLAYER_USERNAME: self.server.player_name[i]
-                } for i in self.server.ids
-            ]
-            for i, client in enumerate(clients):
-                player_id = client[protocol.PLAYER_ID]
-                if not self.server.is_alive[player_id]:
-                    role = protocol.ROLE_WEREWOLF if self.server.is_werewolf[player_id] else protocol.ROLE_CIVILIAN
-                    clients[i][protocol.ROLE] = role
-        data = json.dumps({
-            protocol.STATUS: protocol.STATUS_OK,
-            protocol.DESCRIPTION: protocol.DESC_CLIENT_LIST,
-            protocol.CLIENTS: clients
-        })
-        self.connection.send(data)
-
-    def handle_accepted_proposal(self, message):
-        if self.server.selected_kpu_id is not None:
-            data = json.dumps({
+        if self.player_id is None:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
-                protocol.DESCRIPTION: protocol.DESC_KPU_ALREADY_SELECTED
-            })
+                protocol.DESCRIPTION: protocol.DESC_NOT_JOINED
+            }
             self.connection.send(data)
             return
 
-        elif self.player_id is None:
-            data = json.dumps({
+        # a client that already holds the current roster gets a short reply
+        room = self.room
+        version = message.get(protocol.ROSTER_VERSION) if message else None
+        with room.lock:
+            if version is not None and version == room.roster_version:
+                data = {
+                    protocol.STATUS: protocol.STATUS_OK,
+                    protocol.DESCRIPTION: protocol.DESC_NOT_MODIFIED,
+                    protocol.ROSTER_VERSION: version
+                }
+            else:
+                data = room.roster_frame(self.connection.framer)
+        self.connection.send(data)
+
+    def handle_accepted_proposal(self, message):
+        if self.player_id is None:
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_NOT_JOINED
-            })
+            }
             self.connection.send(data)
             return
 
-        elif protocol.KPU_ID not in message:
-            data = json.dumps({
+        elif not isinstance(message.get(protocol.KPU_ID), int):
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
-        data = json.dumps({
-            protocol.STATUS: protocol.STATUS_OK
-        })
-        self.connection.send(data)
-
+        room = self.room
         kpu_id = message[protocol.KPU_ID]
-        self.server.vote_kpu_id[self.player_id] = kpu_id
-
-        quorum = (self.server.player_count - 2) // 2 + 1
-        set_kpu_id = set(self.server.vote_kpu_id)
-        for kpu_id in set_kpu_id:
-            if kpu_id is None:
-                continue
-            if self.server.vote_kpu_id.count(kpu_id) >= quorum:
-                self.server.selected_kpu_id = kpu_id
-                self.server.kpu_selected(kpu_id)
-                self.server.vote_now()
+        with room.lock:
+            # the candidate may leave at any time, check under the lock
+            if kpu_id not in room.players:
+                data = {
+                    protocol.STATUS: protocol.STATUS_ERROR,
+                    protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
+                }
+                self.connection.send(data)
+                return
+
+            # acceptances race in from every connection, only the one that
+            # makes a candidate reach the quorum announces it
+            if room.selected_kpu_id is not None:
+                data = {
+                    protocol.STATUS: protocol.STATUS_FAIL,
+                    protocol.DESCRIPTION: protocol.DESC_KPU_ALREADY_SELECTED
+                }
+                self.connection.send(data)
                 return
 
+            data = {
+                protocol.STATUS: protocol.STATUS_OK
+            }
+            self.connection.send(data)
+
+            if room.accept_kpu(self.player_id, kpu_id):
+                room.elect_kpu(kpu_id)
+                room.vote_now()
+
     def handle_vote_result_civilian(self, message):
         if self.player_id is None:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_FAIL,
                 protocol.DESCRIPTION: protocol.DESC_NOT_JOINED
-            })
+            }
             self.connection.send(data)
             return
 
         elif protocol.VOTE_STATUS not in message:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
         elif protocol.VOTE_RESULT not in message:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
         try:
             vote_status = int(message[protocol.VOTE_STATUS])
         except ValueError:
-            data = json.dumps({
+            data = {
                 protocol.STATUS: protocol.STATUS_ERROR,
                 protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
+            }
             self.connection.send(data)
             return
 
-        if vote_status > 0 and protocol.PLAYER_KILLED not in message:
-            data = json.dumps({
-                protocol.STATUS: protocol.STATUS_ERROR,
-                protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
-            })
-            self.connection.send(data)
-            return
+        room = self.room
+        with room.lock:
+            # the player voted out may leave at any time, check under the lock
+            if vote_status > 0 and (
+                    not isinstance(message.get(protocol.PLAYER_KILLED), int) or
+                    message[protocol.PLAYER_KILLED] not in room.players):
+                data = {
+                    protocol.STATUS: protocol.STATUS_ERROR,
+                    protocol.DESCRIPTION: protocol.DESC_WRONG_REQUEST
+                }
+                self.connection.send(data)
+                return
 
-        data = json.dumps({
-            protocol.STATUS: protocol.STATUS_OK
-        })
-        self.connection.send(data)
+            data = {
+                protocol.STATUS: protocol.STATUS_OK
+            }
+            self.connection.send(data)
 
-        if vote_status > 0:
-            self.server.player_killed = message[protocol.PLAYER_KILLED]
-            self.server.is_alive[self.server.player_killed] = False
-            self.server.change_phase()
-        else:
-            self.server.vote_now()
+            room.vote_finished()
+            if vote_status > 0:
+                room.player_killed = message[protocol.PLAYER_KILLED]
+                room.kill_player(room.player_killed)
+                room.change_phase()
+            else:
+                room.vote_now()
 
     def handle_vote_result_werewolf(self, message):
         self.handle_vote_result_civilian(message)
@@ -0,0 +1,207 @@
+"""
+Module containing the server metrics, exposed in the Prometheus text format
+"""
+
+import bisect
+import collections
+import http.server
+import threading
+
+from common import protocol
+from server.profiling import Hook
+
+PREFIX = "eureureong_"
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# histograms: name, label and help text
+HANDLER = "handler_seconds"
+BROADCAST = "broadcast_seconds"
+KPU_QUORUM = "kpu_quorum_seconds"
+VOTE_RESULT = "vote_result_seconds"
+HISTOGRAMS = {
+    HANDLER: ("method", "Time spent handling a request."),
+    BROADCAST: ("method", "Time spent sending a message to every player of a room."),
+    KPU_QUORUM: ("kind", "Time from the start of a day until its KPU is selected."),
+    VOTE_RESULT: ("time", "Time from a vote being called until the KPU sends its result."),
+}
+
+
+def _escape(value):
+    # label values may be player names
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(Hook):
+    """Counters updated by the connections and rooms of one server
+    process. Gauges of rooms and players are read from the server when the
+    metrics are rendered."""
+
+    def __init__(self, server):
+        self.server = server
+        self.lock = threading.Lock()
+
+        self.connections = 0
+        self.received_messages = collections.Counter()
+        self.received_bytes = collections.Counter()
+        self.sent_messages = collections.Counter()
+        self.sent_bytes = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.outbox_dropped = 0
+        self.slow_disconnects = 0
+
+    def on_open(self, handler):
+        with self.lock:
+            self.connections += 1
+
+    def on_close(self, handler):
+        with self.lock:
+            self.connections -= 1
+
+    def on_dispatch(self, handler, method, seconds):
+        size = handler.connection.framer.frame_size
+        with self.lock:
+            self.received_messages[method] += 1
+            self.received_bytes[method] += size
+            self.histograms[HANDLER, method].observe(seconds)
+
+    def on_send(self, handler, message, size, method):
+        # replies are counted under the request they answer
+        if method is None:
+            if isinstance(message, dict):
+                method = message.get(protocol.METHOD, handler.method)
+            else:
+                method = handler.method
+        method = method or "unknown"
+        with self.lock:
+            self.sent_messages[method] += 1
+            self.sent_bytes[method] += size
+
+    def on_overflow(self, handler, dropped, disconnected):
+        with self.lock:
+            self.outbox_dropped += dropped
+            self.slow_disconnects += disconnected
+
+    def observe(self, name, label, seconds):
+        with self.lock:
+            self.histograms[name, label].observe(seconds)
+
+    def _players(self):
+        with self.server.lock:
+            rooms = list(self.server.rooms.values())
+
+        players = collections.Counter({"lobby": 0, protocol.TIME_DAY: 0, protocol.TIME_NIGHT: 0})
+        # only the players with output waiting, to keep the series few
+        outboxes = []
+        for room in rooms:
+            phase = room.time if room.is_playing else "lobby"
+            players[phase] += room.player_count
+            for player in list(room.players.values()):
+                outbox = getattr(player.connection, "outbox", None)
+                if outbox:
+                    labels = {"room": room.name, "player": player.username}
+                    outboxes.append((labels, len(outbox), outbox.size))
+        return len(rooms), players, outboxes
+
+    def render(self):
+        rooms, players, outboxes = self._players()
+        lines = []
+
+        def header(name, kind, text):
+            lines.append("# HELP %s%s %s" % (PREFIX, name, text))
+            lines.append("# TYPE %s%s %s" % (PREFIX, name, kind))
+
+        def sample(name, value, labels=None):
+            if labels:
+                labels = "{%s}" % ",".join(
+                    '%s="%s"' % (key, _escape(value)) for key, value in labels.items())
+            lines.append("%s%s%s %s" % (PREFIX, name, labels or "", value))
+
+        with self.lock:
+            header("connections", "gauge", "Open client connections.")
+            sample("connections", self.connections)
+            header("rooms", "gauge", "Open game rooms.")
+            sample("rooms", rooms)
+            header("players", "gauge", "Players by game phase.")
+            for phase, count in sorted(players.items()):
+                sample("players", count, {"phase": phase})
+            header("outbox_messages", "gauge", "Messages waiting to be sent to a slow player.")
+            for labels, messages, size in outboxes:
+                sample("outbox_messages", messages, labels)
+            header("outbox_bytes", "gauge", "Bytes waiting to be sent to a slow player.")
+            for labels, messages, size in outboxes:
+                sample("outbox_bytes", size, labels)
+            header("outbox_dropped_total", "counter", "Queued messages dropped for a newer one of the same method.")
+            sample("outbox_dropped_total", self.outbox_dropped)
+            header("slow_disconnects_total", "counter", "Clients disconnected because their outbox overflowed.")
+            sample("slow_disconnects_total", self.slow_disconnects)
+
+            for name, counter, text in (
+                    ("messages_received_total", self.received_messages, "Messages received by method."),
+                    ("bytes_received_total", self.received_bytes, "Bytes received by method."),
+                    ("messages_sent_total", self.sent_messages, "Messages sent by method, replies count under the request."),
+                    ("bytes_sent_total", self.sent_bytes, "Bytes sent by method, replies count under the request.")):
+                header(name, "counter", text)
+                for method, value in sorted(counter.items()):
+                    sample(name, value, {"method": method})
+
+            for name, (label, text) in HISTOGRAMS.items():
+                header(name, "histogram", text)
+                for (key, value), histogram in sorted(self.histograms.items()):
+                    if key != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        sample(name + "_bucket", cumulative, {label: value, "le": bound})
+                    sample(name + "_sum", histogram.sum, {label: value})
+                    sample(name + "_count", histogram.count, {label: value})
+
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsServer(threading.Thread):
+    """Serves the metrics over HTTP on a local port for a scraper."""
+
+    def __init__(self, metrics, port, host="127.0.0.1"):
+        super().__init__(daemon=True)
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), RequestHandler)
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
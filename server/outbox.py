@@ -0,0 +1,146 @@
+"""
+Module containing the bounded outbound queue of a server connection
+"""
+
+import collections
+import itertools
+import logging
+
+from common import protocol
+
+logger = logging.getLogger(__name__)
+
+COALESCE = "coalesce"
+DISCONNECT = "disconnect"
+POLICIES = (COALESCE, DISCONNECT)
+
+# a newer message of these methods makes the queued older ones pointless:
+# there is one KPU at a time, and a client that misses a roster push
+# fetches the whole roster on its next request
+SUPERSEDED = frozenset((protocol.METHOD_KPU_SELECTED, protocol.METHOD_ROSTER_UPDATE))
+
+# the KPU is elected for one day, a phase change in between keeps both
+PHASED = frozenset((protocol.METHOD_KPU_SELECTED,))
+
+
+class Outbox:
+    """Frames waiting to be written to one client, bounded in bytes and in
+    messages. When a frame does not fit, the coalesce policy first drops
+    the queued state updates a newer one supersedes. If it still does not
+    fit, or under the disconnect policy, the outbox overflows: put()
+    returns False from then on and the client is to be disconnected."""
+
+    def __init__(self, max_bytes=262144, max_messages=256, policy=COALESCE):
+        if policy not in POLICIES:
+            raise ValueError("Unknown overflow policy '%s'" % policy)
+        self.max_bytes = max_bytes
+        self.max_messages = max_messages
+        self.policy = policy
+
+        # the first frame may be partly written already, and the first
+        # in_flight frames may be handed to a send that has not returned
+        self.frames = collections.deque()
+        self.methods = collections.deque()
+        self.size = 0
+        self.in_flight = 0
+        self.dropped = 0
+        self.overflowed = False
+
+    def __len__(self):
+        return len(self.frames)
+
+    def is_full(self):
+        return self.size > self.max_bytes or len(self.frames) > self.max_messages
+
+    def put(self, frame, method=None):
+        if self.overflowed:
+            return False
+
+        self.frames.append(memoryview(frame))
+        self.methods.append(method)
+        self.size += len(frame)
+        if self.is_full() and self.policy == COALESCE:
+            self._coalesce()
+        # a frame always fits an empty outbox, however large
+        if len(self.frames) > 1 and self.is_full():
+            self.overflowed = True
+            return False
+        return True
+
+    def take(self, count):
+        """Returns up to count frames from the front of the queue to send.
+        They stay queued, and are not coalesced away, until the send
+        returned and consume() was called."""
+        frames = list(itertools.islice(self.frames, count))
+        self.in_flight = len(frames)
+        return frames
+
+    def consume(self, sent):
+        """Drops sent bytes from the front of the queue, after the frames
+        taken last were sent."""
+        self.in_flight = 0
+        self.size -= sent
+        while sent:
+            frame = self.frames[0]
+            if len(frame) > sent:
+                self.frames[0] = frame[sent:]
+                break
+            sent -= len(frame)
+            self.frames.popleft()
+            self.methods.popleft()
+
+    def clear(self):
+        """Drops every frame but the ones taken and still being sent, their
+        consume() is yet to come."""
+        while len(self.frames) > self.in_flight:
+            self.size -= len(self.frames.pop())
+            self.methods.pop()
+
+    def _coalesce(self):
+        # walk back from the newest frame; the frames being sent, or at
+        # least the first one that may be partly written, always stay
+        latest = set()
+        kept = collections.deque()
+        while len(self.frames) > max(1, self.in_flight):
+            frame = self.frames.pop()
+            method = self.methods.pop()
+            if method in SUPERSEDED:
+                if method in latest:
+                    self.size -= len(frame)
+                    self.dropped += 1
+                    continue
+                latest.add(method)
+            elif method == protocol.METHOD_CHANGE_PHASE:
+                latest -= PHASED
+            kept.appendleft((frame, method))
+
+        for frame, method in kept:
+            self.frames.append(frame)
+            self.methods.append(method)
+
+
+def enqueue(connection, frame, method=None):
+    """Queues a frame on connection.outbox and returns whether it was
+    queued. A connection whose outbox overflows is aborted: its reader
+    then sees the end of the stream and closes it the usual way, closing
+    right here could re-enter a handler that holds the room lock."""
+    outbox = connection.outbox
+    dropped = outbox.dropped
+    overflowed = outbox.overflowed
+    queued = outbox.put(frame, method)
+
+    hooks = connection.server.hooks
+    if hooks is not None and (outbox.dropped != dropped or outbox.overflowed != overflowed):
+        hooks.overflowed(connection.handler, outbox.dropped - dropped, outbox.overflowed)
+    if queued or overflowed:
+        return queued
+
+    handler = connection.handler
+    logger.warning(
+        "Disconnecting slow client %s (player '%s' in room '%s'), %d messages "
+        "and %d bytes are waiting", connection.addr, handler.username,
+        handler.room.name if handler.room is not None else None,
+        len(outbox), outbox.size)
+    outbox.clear()
+    connection.abort()
+    return False
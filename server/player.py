@@ -0,0 +1,18 @@
+class Player:
+
+    __slots__ = (
+        "id", "username", "connection", "address", "port", "features",
+        "is_ready", "is_alive", "is_werewolf",
+    )
+
+    def __init__(self, player_id, username, connection, address, port, features=()):
+        self.id = player_id
+        self.username = username
+        self.connection = connection
+        self.address = address
+        self.port = port
+        self.features = frozenset(features)
+
+        self.is_ready = False
+        self.is_alive = True
+        self.is_werewolf = False
@@ -0,0 +1,151 @@
+"""
+Module containing the instrumentation hooks of the server hot paths
+"""
+
+import cProfile
+import logging
+import os
+import random
+import signal
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Hook:
+    """Base class for instrumentation, override the events of interest.
+    Hooks run inline on the I/O path and should be quick."""
+
+    def on_open(self, handler):
+        pass
+
+    def on_close(self, handler):
+        pass
+
+    def on_receive(self, handler, size, seconds):
+        """A chunk read from the socket was parsed and its frames handled."""
+        pass
+
+    def on_dispatch(self, handler, method, seconds):
+        pass
+
+    def on_send(self, handler, message, size, method):
+        pass
+
+    def on_overflow(self, handler, dropped, disconnected):
+        """The outbox of a slow client dropped superseded frames, or
+        overflowed and the client is being disconnected."""
+        pass
+
+
+class Profiler:
+    """Runs cProfile over a random fraction of the dispatched messages,
+    one at a time, and accumulates the statistics until dumped into
+    directory, the temporary one by default."""
+
+    def __init__(self, rate=0.01, directory=None):
+        self.rate = rate
+        self.path = os.path.join(directory or tempfile.gettempdir(),
+                                 "eureureong-%d.prof" % os.getpid())
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.samples = 0
+
+    def sample(self):
+        return random.random() < self.rate
+
+    def run(self, func, *args):
+        # a profile follows one thread, skip the sample if one is running
+        if not self.lock.acquire(blocking=False):
+            return func(*args)
+        try:
+            self.profile.enable()
+            try:
+                return func(*args)
+            finally:
+                self.profile.disable()
+                self.samples += 1
+        finally:
+            self.lock.release()
+
+    def dump(self):
+        with self.lock:
+            if not self.samples:
+                logger.info("No message profiled yet")
+                return
+            self.profile.dump_stats(self.path)
+        logger.info("Dumped %d profiled messages to %s", self.samples, self.path)
+
+
+class Hooks:
+    """The hooks and sampling profiler installed on a server. A server
+    without instrumentation has no Hooks at all, so the hot paths only pay
+    for a None check."""
+
+    def __init__(self, profiler=None):
+        self.hooks = []
+        self.profiler = profiler
+
+    def add(self, hook):
+        self.hooks.append(hook)
+
+    def opened(self, handler):
+        for hook in self.hooks:
+            hook.on_open(handler)
+
+    def closed(self, handler):
+        for hook in self.hooks:
+            hook.on_close(handler)
+
+    def received(self, handler, size, seconds):
+        for hook in self.hooks:
+            hook.on_receive(handler, size, seconds)
+
+    def dispatch(self, handler, method, handle_method, message):
+        start = time.perf_counter()
+        profiler = self.profiler
+        if profiler is not None and profiler.sample():
+            profiler.run(handle_method, message)
+        else:
+            handle_method(message)
+        seconds = time.perf_counter() - start
+        for hook in self.hooks:
+            hook.on_dispatch(handler, method, seconds)
+
+    def sent(self, handler, message, size, method):
+        for hook in self.hooks:
+            hook.on_send(handler, message, size, method)
+
+    def overflowed(self, handler, dropped, disconnected):
+        for hook in self.hooks:
+            hook.on_overflow(handler, dropped, disconnected)
+
+
+def install_signals(server, rate=0.01):
+    """SIGUSR2 turns the sampling profiler on and off, SIGUSR1 dumps what
+    it collected so far, both on a running server."""
+    if not hasattr(signal, "SIGUSR1") or threading.current_thread() is not threading.main_thread():
+        return
+
+    def toggle(signum, frame):
+        if server.hooks is None:
+            server.hooks = Hooks()
+        hooks = server.hooks
+        if hooks.profiler is None:
+            hooks.profiler = server.profiler = server.profiler or Profiler(rate, server.profile_dir)
+            logger.info("Profiling %g of the messages", hooks.profiler.rate)
+        else:
+            hooks.profiler = None
+            if not hooks.hooks:
+                server.hooks = None
+            logger.info("Profiling stopped")
+
+    def dump(signum, frame):
+        # the interrupted code may hold the profiler lock
+        if server.profiler is not None:
+            threading.Thread(target=server.profiler.dump).start()
+
+    signal.signal(signal.SIGUSR1, dump)
+    signal.signal(signal.SIGUSR2, toggle)
@@ -0,0 +1,220 @@
+import logging
+import selectors
+import socket
+import time
+
+from common import log
+from common.framing import Framer, FramingError
+from server.server import Server, set_keepalive
+from server.handler import Handler
+from server.outbox import Outbox, enqueue
+
+logger = logging.getLogger(__name__)
+
+
+class ReactorServer(Server):
+
+    def __init__(self, host='', port=9999, channel=None, rules=None, metrics_port=None,
+                 profile_rate=0, outbox_limits=None, heartbeat_interval=10, idle_timeout=30,
+                 profile_dir=None):
+        super().__init__(host, port, channel, rules, metrics_port, profile_rate, outbox_limits,
+                         heartbeat_interval, idle_timeout, profile_dir)
+
+        self.selector = selectors.DefaultSelector()
+        self.socket.setblocking(False)
+
+        # self-pipe so close() can wake a selector that waits without timeout
+        self.waker, self.waker_writer = socket.socketpair()
+        self.waker.setblocking(False)
+
+    def serve_forever(self):
+        try:
+            self.selector.register(self.socket, selectors.EVENT_READ, self._accept)
+            self.selector.register(self.waker, selectors.EVENT_READ, self._wake)
+            if self.channel is None:
+                logger.info("Listening to client connections on port %d", self.port)
+            else:
+                logger.info("Waiting for connections from the supervisor")
+            # without heartbeats nothing is due between events
+            tick = self.timeout if self.idle_timeout else None
+            swept = time.monotonic()
+            while self.keep_running:
+                for key, mask in self.selector.select(tick):
+                    key.data(mask)
+
+                now = time.monotonic()
+                if tick is not None and now - swept >= tick:
+                    swept = now
+                    self._sweep(now)
+
+        except KeyboardInterrupt:
+            logger.info("Terminated by user")
+
+        finally:
+            self.keep_running = False
+            for connection in list(self.connections):
+                connection.close()
+            self.selector.close()
+            self.waker.close()
+            self.waker_writer.close()
+            self.socket.close()
+
+    def _accept(self, mask):
+        try:
+            accepted = self.accept_client()
+        except BlockingIOError:
+            return
+        if accepted is None:
+            logger.info("Supervisor is gone, exiting")
+            self.keep_running = False
+            return
+
+        client_socket, client_addr, data = accepted
+        logger.debug("Connection from %s", client_addr)
+
+        connection = ReactorConnection(self, client_socket, client_addr, data)
+        self.connections.append(connection)
+
+    def _sweep(self, now):
+        for connection in list(self.connections):
+            if connection.handler.check_idle(now):
+                connection.close()
+
+    def _wake(self, mask):
+        try:
+            self.waker.recv(64)
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.keep_running = False
+        try:
+            self.waker_writer.send(b"\0")
+        except OSError:
+            pass
+
+
+class ReactorConnection:
+
+    def __init__(self, server, client_socket, client_addr, data=b""):
+        self.buf_size = 2048
+
+        self.server = server
+        self.socket = client_socket
+        self.addr = client_addr
+        self.handler = Handler(server, self)
+        self.framer = Framer()
+        set_keepalive(client_socket, server.idle_timeout, server.heartbeat_interval)
+
+        # frames are queued as they are, a broadcast frame is shared by
+        # every connection it goes to instead of being copied into each
+        self.outbox = Outbox(**server.outbox_limits)
+        self.max_iov = 64
+        self.is_closed = False
+
+        self.socket.setblocking(False)
+        self.events = selectors.EVENT_READ
+        self.server.selector.register(self.socket, self.events, self._on_event)
+
+        # bytes the supervisor already read while routing this connection
+        if data:
+            self._handle(data)
+
+    def _on_event(self, mask):
+        if mask & selectors.EVENT_READ:
+            self._recv()
+        if mask & selectors.EVENT_WRITE and not self.is_closed:
+            self._flush()
+
+    def _recv(self):
+        try:
+            # receive the packet
+            message = self.socket.recv(self.buf_size)
+        except BlockingIOError:
+            return
+        except ConnectionError:
+            logger.debug("Client %s disconnected", self.addr)
+            self.close()
+            return
+        except OSError:
+            logger.exception("Dropping client %s", self.addr)
+            self.close()
+            return
+
+        # client is disconnected
+        if not message:
+            logger.debug("Client %s disconnected", self.addr)
+            self.close()
+            return
+
+        self._handle(message)
+
+    def _handle(self, message):
+        if log.sample_payload():
+            logger.debug("Received %d bytes from %s: %r", len(message), self.addr, message)
+
+        try:
+            # handle every complete frame, keep the rest for next recv
+            self.handler.feed(message)
+
+        except FramingError as e:
+            logger.warning("Dropping client %s: %s", self.addr, e)
+            self.close()
+
+        except Exception:
+            logger.exception("Dropping client %s", self.addr)
+            self.close()
+
+    def _flush(self):
+        try:
+            sent = self.socket.sendmsg(self.outbox.take(self.max_iov))
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            # the peer is gone; the read side sees it and closes the connection,
+            # closing here could re-enter a handler that holds the room lock
+            self.outbox.consume(0)
+            self.outbox.clear()
+            sent = 0
+        self.outbox.consume(sent)
+
+        events = selectors.EVENT_READ
+        if self.outbox:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.server.selector.modify(self.socket, events, self._on_event)
+
+    def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        self.server.selector.unregister(self.socket)
+
+        self.handler.close()
+        self.socket.close()
+        if self in self.server.connections:
+            self.server.connections.remove(self)
+
+    def abort(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def send(self, message, method=None):
+        if self.is_closed:
+            return
+        data = self.framer.encode(message)
+        if log.sample_payload():
+            logger.debug("Sending to %s: %r", self.addr, data)
+
+        # queue behind pending output, only write right away when nothing is
+        # waiting so the order on the wire is kept
+        was_empty = not self.outbox
+        if not enqueue(self, data, method):
+            return
+        hooks = self.server.hooks
+        hooks is not None and hooks.sent(self.handler, message, len(data), method)
+        if was_empty:
+            self._flush()
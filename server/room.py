@@ -0,0 +1,408 @@
+import collections
+import heapq
+import logging
+import threading
+import random
+import time
+
+from common import protocol
+from common.framing import MessageTemplate
+from server import metrics
+from server.player import Player
+
+logger = logging.getLogger(__name__)
+
+
+class Room:
+
+    def __init__(self, name, min_player=6, max_player=8, werewolves=2, werewolf_ratio=None,
+                 kpu_lease=0, metrics=None, rng=None):
+        self.name = name
+        self.is_closed = False
+        self.metrics = metrics
+        # werewolves are drawn from it, a simulation seeds it
+        self.rng = rng or random.Random()
+
+        self.lock = threading.Lock()
+
+        self._init_game(min_player, max_player, werewolves, werewolf_ratio, kpu_lease)
+        self.reset_game()
+
+    def _init_game(self, min_player, max_player, werewolves, werewolf_ratio, kpu_lease):
+        self.MIN_PLAYER = min_player
+        self.MAX_PLAYER = max_player
+        self.MAX_WEREWOLF = werewolves
+        self.WEREWOLF_RATIO = werewolf_ratio
+        # days an elected KPU keeps the office without a new election,
+        # 0 elects a new one every day
+        self.KPU_LEASE = kpu_lease
+
+        # players by id in join order, and the same players by username
+        self.players = {}
+        self.usernames = {}
+        # free ids as a heap, the lowest id is handed out first, also
+        # after players left
+        self.free_ids = list(range(self.MAX_PLAYER))
+
+        self.selected_kpu_id = None
+        self.kpu_day = 0
+        # when the running election and vote began, for the metrics
+        self.election_started = None
+        self.election_kind = None
+        self.vote_started = None
+        # the KPU each player accepted, and how many players accepted each
+        self.kpu_votes = {}
+        self.kpu_tally = collections.Counter()
+
+        # every roster change bumps the version; changes since the last push
+        # are kept by player id, and full client lists are cached per format
+        self.roster_version = 0
+        self.roster_pushed_version = 0
+        self.roster_changes = set()
+        self.roster_frames = {}
+
+    def reset_game(self):
+        self.is_playing = False
+        self.day = 0
+        self.time = protocol.TIME_NIGHT
+
+        self.ready_count = 0
+        self.alive_werewolves = 0
+        self.alive_civilians = 0
+        for player in self.players.values():
+            player.is_ready = False
+            player.is_alive = True
+            player.is_werewolf = False
+            self.alive_civilians += 1
+
+    @property
+    def player_count(self):
+        return len(self.players)
+
+    def add_player(self, username, connection, address, port, features=()):
+        player = Player(heapq.heappop(self.free_ids), username, connection, address, port, features)
+        self.players[player.id] = player
+        self.usernames[username] = player
+        self.alive_civilians += 1
+        self._roster_changed(player.id)
+        return player
+
+    def remove_player(self, player_id):
+        player = self.players.pop(player_id, None)
+        if player is None:
+            return
+        del self.usernames[player.username]
+        heapq.heappush(self.free_ids, player_id)
+
+        if player.is_ready:
+            self.ready_count -= 1
+        kpu_id = self.kpu_votes.pop(player_id, None)
+        if kpu_id is not None:
+            self.kpu_tally[kpu_id] -= 1
+        if player.is_alive:
+            self._count_alive(player, -1)
+        player.connection = None
+        self._roster_changed(player_id)
+
+    def set_ready(self, player_id):
+        player = self.players[player_id]
+        if not player.is_ready:
+            player.is_ready = True
+            self.ready_count += 1
+
+    def kill_player(self, player_id):
+        player = self.players.get(player_id)
+        if player is not None and player.is_alive:
+            player.is_alive = False
+            self._count_alive(player, -1)
+            self._roster_changed(player_id)
+
+    def accept_kpu(self, player_id, kpu_id):
+        """Records the KPU a player accepted, returns True when that
+        candidate reaches the quorum. Call with the room lock held."""
+        previous = self.kpu_votes.get(player_id)
+        if previous != kpu_id:
+            if previous is not None:
+                self.kpu_tally[previous] -= 1
+            self.kpu_votes[player_id] = kpu_id
+            self.kpu_tally[kpu_id] += 1
+
+        quorum = (self.player_count - 2) // 2 + 1
+        return self.kpu_tally[kpu_id] >= quorum
+
+    def _roster_changed(self, player_id):
+        self.roster_version += 1
+        self.roster_changes.add(player_id)
+        self.roster_frames.clear()
+
+    def roster_entry(self, player):
+        entry = {
+            protocol.PLAYER_ID: player.id,
+            protocol.PLAYER_IS_ALIVE: 1 if player.is_alive else 0,
+            protocol.PLAYER_ADDRESS: player.address,
+            protocol.PLAYER_PORT: player.port,
+            protocol.PLAYER_USERNAME: player.username
+        }
+        # roles are only revealed for the dead
+        if not player.is_alive:
+            role = protocol.ROLE_WEREWOLF if player.is_werewolf else protocol.ROLE_CIVILIAN
+            entry[protocol.ROLE] = role
+        return entry
+
+    def roster_frame(self, framer):
+        """Returns the full client list reply encoded for the framer, built
+        once per roster version and wire format."""
+        frame = self.roster_frames.get(framer.format)
+        if frame is None:
+            data = {
+                protocol.STATUS: protocol.STATUS_OK,
+                protocol.DESCRIPTION: protocol.DESC_CLIENT_LIST,
+                protocol.CLIENTS: [
+                    self.roster_entry(player) for player in self.players.values()
+                ],
+                protocol.ROSTER_VERSION: self.roster_version
+            }
+            frame = self.roster_frames[framer.format] = framer.encode(data)
+        return frame
+
+    def push_roster(self):
+        """Sends the roster entries changed since the last push to the
+        players that asked for pushes. Before the game starts nobody holds
+        a roster yet, so changes are just dropped."""
+        if not self.roster_changes:
+            return
+
+        if self.is_playing:
+            clients = []
+            removed = []
+            for player_id in self.roster_changes:
+                player = self.players.get(player_id)
+                if player is None:
+                    removed.append(player_id)
+                else:
+                    clients.append(self.roster_entry(player))
+
+            data = {
+                protocol.METHOD: protocol.METHOD_ROSTER_UPDATE,
+                protocol.ROSTER_VERSION: self.roster_version,
+                protocol.ROSTER_PREVIOUS_VERSION: self.roster_pushed_version,
+                protocol.CLIENTS: clients,
+                protocol.ROSTER_REMOVED: removed
+            }
+            self.broadcast(data, protocol.FEATURE_ROSTER_PUSH)
+
+        self.roster_pushed_version = self.roster_version
+        self.roster_changes.clear()
+
+    def werewolf_count(self):
+        if self.WEREWOLF_RATIO:
+            count = int(self.player_count * self.WEREWOLF_RATIO)
+        else:
+            count = self.MAX_WEREWOLF
+        # werewolves have to start outnumbered or the game is over at once
+        return max(1, min(count, (self.player_count - 1) // 2))
+
+    def _count_alive(self, player, delta):
+        if player.is_werewolf:
+            self.alive_werewolves += delta
+        else:
+            self.alive_civilians += delta
+
+    def broadcast(self, message, feature=None):
+        # encode once per wire format and hand the same bytes to everyone,
+        # or only to the players that announced the feature at join
+        method = message[protocol.METHOD]
+        start = time.perf_counter() if self.metrics is not None else None
+        frames = {}
+        for player in self.players.values():
+            if feature is not None and feature not in player.features:
+                continue
+            connection = player.connection
+            if connection:
+                key = connection.framer.format
+                frame = frames.get(key)
+                if frame is None:
+                    frame = frames[key] = connection.framer.encode(message)
+                connection.send(frame, method)
+        if start is not None:
+            self.metrics.observe(metrics.BROADCAST, method, time.perf_counter() - start)
+
+    def _time_election(self, kind):
+        if self.metrics is not None:
+            self.election_started = time.perf_counter()
+            self.election_kind = kind
+
+    def start_game(self):
+        if self.is_playing or self.player_count < self.MIN_PLAYER:
+            return
+
+        logger.info("Starting the game in room '%s' with %d players", self.name, self.player_count)
+        self.push_roster()
+        self.is_playing = True
+        self.day = 1
+        self.time = protocol.TIME_DAY
+        self.retry_vote = 2
+        self.player_killed = None
+
+        werewolves = self.rng.sample(list(self.players.values()), self.werewolf_count())
+        for player in werewolves:
+            self._count_alive(player, -1)
+            player.is_werewolf = True
+            self._count_alive(player, 1)
+
+        # the long description is serialized once, players only differ by role
+        template = MessageTemplate({
+            protocol.METHOD: protocol.METHOD_START,
+            protocol.TIME: self.time,
+            protocol.DESCRIPTION: protocol.DESC_GAME_START,
+            protocol.WEREWOLF_COUNT: len(werewolves)
+        })
+        for player in self.players.values():
+            if player.is_werewolf:
+                friends = [
+                    werewolf.username
+                    for werewolf in werewolves
+                    if werewolf is not player
+                ]
+                data = {
+                    protocol.ROLE: protocol.ROLE_WEREWOLF,
+                    protocol.FRIEND: friends
+                }
+            else:
+                data = {
+                    protocol.ROLE: protocol.ROLE_CIVILIAN
+                }
+
+            connection = player.connection
+            if connection:
+                connection.send(template.encode(connection.framer, data), protocol.METHOD_START)
+        self._time_election("election")
+
+    def change_phase(self):
+        # clients learn about the death before the phase announcement
+        self.push_roster()
+
+        if self.alive_werewolves == 0:
+            self.game_over(protocol.ROLE_CIVILIAN)
+            return
+        elif self.alive_werewolves >= self.alive_civilians:
+            self.game_over(protocol.ROLE_WEREWOLF)
+            return
+
+        lease = None
+        if self.time == protocol.TIME_NIGHT:
+            self.time = protocol.TIME_DAY
+            self.day += 1
+            self.retry_vote = 2
+            incumbent = self.players.get(self.selected_kpu_id)
+            if self.KPU_LEASE and incumbent is not None and incumbent.is_alive:
+                lease = self.kpu_lease()
+            if not lease:
+                self.selected_kpu_id = None
+            self.kpu_votes.clear()
+            self.kpu_tally.clear()
+        else:
+            self.time = protocol.TIME_NIGHT
+
+        data = {
+            protocol.METHOD: protocol.METHOD_CHANGE_PHASE,
+            protocol.TIME: self.time,
+            protocol.DAYS: self.day
+        }
+        if lease is not None:
+            # the KPU carries on; with the lease expired it renews it with
+            # a single accept round instead of a full election
+            data[protocol.KPU_ID] = incumbent.id
+            data[protocol.KPU_LEASE] = lease
+        if self.time == protocol.TIME_DAY:
+            data[protocol.DESCRIPTION] = (
+                "Dan pagi hari telah menjelang, warga desa perlahan "
+                "terbangun dari tidurnya. Semuanya karakter berubah menjadi "
+                "rakyat biasa. Tadi malam, seorang warga bernama '%s' ditemukan tewas.") % (self.players[self.player_killed].username)
+        else:
+            str_desc = ""
+            if self.player_killed is None:
+                str_desc += (
+                    "Rapat bejalan alot. Walau telah dilakukan pemilihan sebanyak 2x, "
+                    "perundingan para warga tidak menghasilkan apapun. "
+                    "Tidak ada yang terbunuh di siang itu."
+                )
+            else:
+                str_desc += (
+                    "Setelah berunding, warga desa memilih untuk membunuh '%s'. ") % (self.players[self.player_killed].username)
+                if self.players[self.player_killed].is_werewolf:
+                    str_desc += (
+                        "Untungnya dia adalah seorang werewolf.")
+                else:
+                    str_desc += (
+                        "Namun sayangnya dia hanyalah seorang warga biasa tak berdosa...")
+            str_desc += "\n\n"
+
+            data[protocol.DESCRIPTION] = str_desc + (
+                "Saat ini, hari telah malam, warga desa yang "
+                "kelelahan kini mulai perlahan terlelap. Werewolf pun "
+                "beraksi...")
+        self.player_killed = None
+        self.broadcast(data)
+
+        if self.time == protocol.TIME_NIGHT:
+            self.vote_now()
+        elif lease:
+            self.kpu_selected(self.selected_kpu_id)
+            self.vote_now()
+        else:
+            self._time_election("election" if lease is None else "renewal")
+
+    def kpu_lease(self):
+        """Days left on the KPU lease, 0 once it ran out."""
+        return max(0, self.KPU_LEASE - (self.day - self.kpu_day))
+
+    def elect_kpu(self, kpu_id):
+        self.selected_kpu_id = kpu_id
+        self.kpu_day = self.day
+        if self.election_started is not None:
+            self.metrics.observe(
+                metrics.KPU_QUORUM, self.election_kind,
+                time.perf_counter() - self.election_started)
+            self.election_started = None
+        self.kpu_selected(kpu_id)
+
+    def kpu_selected(self, kpu_id):
+        data = {
+            protocol.METHOD: protocol.METHOD_KPU_SELECTED,
+            protocol.KPU_ID: kpu_id
+        }
+        self.broadcast(data)
+
+    def vote_now(self):
+        if self.time == protocol.TIME_DAY:
+            if self.retry_vote > 0:
+                self.retry_vote -= 1
+            else:
+                self.change_phase()
+                return
+        data = {
+            protocol.METHOD: protocol.METHOD_VOTE_NOW,
+            protocol.PHASE: self.time
+        }
+        self.broadcast(data)
+        if self.metrics is not None:
+            self.vote_started = time.perf_counter()
+
+    def vote_finished(self):
+        if self.vote_started is not None:
+            self.metrics.observe(
+                metrics.VOTE_RESULT, self.time, time.perf_counter() - self.vote_started)
+            self.vote_started = None
+
+    def game_over(self, winner):
+        str_desc = "Permainan telah berakhir. "
+        if self.player_killed is not None:
+            str_desc += (
+                "Pemain '%s' terbunuh.\n") % (self.players[self.player_killed].username)
+        data = {
+            protocol.METHOD: protocol.METHOD_GAME_OVER,
+            protocol.WINNER: winner,
+            protocol.DESCRIPTION: str_desc + "Pemenangnya adalah: %s!" % (winner)
+        }
+        self.broadcast(data)
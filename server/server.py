@@ -1,84 +1,125 @@
+import logging
 import socket
 import select
 import threading
-import json
 
 import random
 import time
 
-from common import protocol
+from common import log
+from common.framing import Framer, FramingError
 from server.handler import Handler
+from server.outbox import Outbox, enqueue
+from server.metrics import Metrics, MetricsServer
+from server.profiling import Hooks, Profiler, install_signals
+from server.room import Room
+from server.worker import recv_handoff
+
+logger = logging.getLogger(__name__)
+
+
+def set_keepalive(client_socket, idle, interval, count=3):
+    """Lets the kernel find a dead peer of a client that does not answer
+    heartbeats: probes after idle seconds of silence, and gives up on
+    data that stays unacknowledged for as long."""
+    if not idle:
+        return
+    client_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the finer knobs are not available everywhere
+    for option, value in (
+            ("TCP_KEEPIDLE", idle),
+            ("TCP_KEEPINTVL", interval),
+            ("TCP_KEEPCNT", count),
+            ("TCP_USER_TIMEOUT", int(idle * 1000))):
+        if hasattr(socket, option):
+            try:
+                client_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), max(1, int(value)))
+            except OSError:
+                pass
 
 
 class Server:
 
-    def __init__(self, host='', port=9999):
-        self.verbose = True
+    def __init__(self, host='', port=9999, channel=None, rules=None, metrics_port=None,
+                 profile_rate=0, outbox_limits=None, heartbeat_interval=10, idle_timeout=30,
+                 profile_dir=None):
         self.keep_running = True
         self.timeout = 1
 
         self.host = host
         self.port = port
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.socket.bind((self.host, self.port))
-        self.socket.listen(6)
+        self.channel = channel
+        if channel is None:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.socket.bind((self.host, self.port))
+            self.socket.listen(128)
+        else:
+            # a worker process gets its connections from the supervisor
+            self.socket = channel
+
+        # keyword arguments for every new Room, see Room.__init__
+        self.rules = rules or {}
+        # keyword arguments for the Outbox of every connection
+        self.outbox_limits = outbox_limits or {}
+        # seconds between pings to a quiet client, and of silence after
+        # which it is dropped; 0 turns both heartbeats and keepalive off
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
 
         self.lock = threading.Lock()
+        self.rooms = {}
         self.client_sockets = []
         self.client_addrs = []
         self.connections = []
 
-        self._init_game()
-        self.reset_game()
+        # instrumentation, hooks stay None unless something is installed
+        self.hooks = None
+        self.metrics = None
+        self.profiler = None
+        self.profile_dir = profile_dir
+        if profile_rate:
+            self.profiler = Profiler(profile_rate, profile_dir)
+        if metrics_port is not None:
+            self.metrics = Metrics(self)
+            MetricsServer(self.metrics, metrics_port).start()
+            logger.info("Serving metrics at 127.0.0.1:%d", metrics_port)
+        if self.metrics is not None or self.profiler is not None:
+            self.hooks = Hooks(self.profiler)
+            if self.metrics is not None:
+                self.hooks.add(self.metrics)
+        install_signals(self, profile_rate or 0.01)
 
         random.seed()
 
-    def _init_game(self):
-        self.MIN_PLAYER = 6
-        self.MAX_PLAYER = 8
-        self.MAX_WEREWOLF = 2
-
-        self.player_count = 0
-        self.ids = []
-        self.usernames = set()
-        self.id_taken = [False] * self.MAX_PLAYER
-        self.player_name = [None] * self.MAX_PLAYER
-        self.player_connection = [None] * self.MAX_PLAYER
-        self.player_address = [None] * self.MAX_PLAYER
-        self.player_port = [None] * self.MAX_PLAYER
-
-        self.selected_kpu_id = None
-        self.vote_kpu_id = [None] * self.MAX_PLAYER
-
-    def reset_game(self):
-        self.is_playing = False
-        self.day = 0
-        self.time = protocol.TIME_NIGHT
-        self.is_ready = [False] * self.MAX_PLAYER
-        self.is_alive = [False] * self.MAX_PLAYER
-        self.is_werewolf = [False] * self.MAX_PLAYER
-
     def serve_forever(self):
         try:
-            self.verbose and print("Listening to client connections...")
+            if self.channel is None:
+                logger.info("Listening to client connections on port %d", self.port)
+            else:
+                logger.info("Waiting for connections from the supervisor")
             while self.keep_running:
                 readable, _, _ = select.select([self.socket], [], [], self.timeout)
                 if self.socket not in readable:
                     continue
 
-                client_socket, client_addr = self.socket.accept()
-                self.verbose and print("Get connection from", str(client_addr))
+                accepted = self.accept_client()
+                if accepted is None:
+                    logger.info("Supervisor is gone, exiting")
+                    break
+
+                client_socket, client_addr, data = accepted
+                logger.debug("Connection from %s", client_addr)
 
                 self.client_sockets.append(client_socket)
                 self.client_addrs.append(client_addr)
 
-                connection = Connection(self, client_socket, client_addr)
+                connection = Connection(self, client_socket, client_addr, data)
                 self.connections.append(connection)
                 connection.start()
 
         except KeyboardInterrupt:
-            self.verbose and print("Terminated by user")
+            logger.info("Terminated by user")
 
         finally:
             self.keep_running = False
@@ -89,216 +130,155 @@ class Server:
     def close(self):
         self.keep_running = False
 
-    def broadcast(self, message):
-        for pid in self.ids:
-            connection = self.player_connection[pid]
-            if connection:
-                connection.send(message)
-
-    def start_game(self):
-        if self.is_playing or self.player_count < self.MIN_PLAYER:
-            return
-
-        self.verbose and print("Starting the game...")
-        self.is_playing = True
-        self.day = 1
-        self.time = protocol.TIME_DAY
-        self.retry_vote = 2
-        self.player_killed = None
-
-        candidate = list(self.ids)
-        for i in range(self.MAX_WEREWOLF):
-            x = random.randint(0, len(candidate)-1)
-            self.is_werewolf[candidate[x]] = True
-            del candidate[x]
-
-        for pid in self.ids:
-            data = {
-                protocol.METHOD: protocol.METHOD_START,
-                protocol.TIME: self.time,
-                protocol.DESCRIPTION: protocol.DESC_GAME_START
-            }
-            if self.is_werewolf[pid]:
-                friends = [
-                    self.player_name[i]
-                    for i in self.ids
-                    if i != pid and self.is_werewolf[i]
-                ]
-                data[protocol.ROLE] = protocol.ROLE_WEREWOLF
-                data[protocol.FRIEND] = friends
-            else:
-                data[protocol.ROLE] = protocol.ROLE_CIVILIAN
-
-            connection = self.player_connection[pid]
-            if connection:
-                connection.send(data)
-
-    def change_phase(self):
-        werewolves = [i for i in range(self.MAX_PLAYER) if self.is_alive[i] and self.is_werewolf[i]]
-        civilians = [i for i in range(self.MAX_PLAYER) if self.is_alive[i] and not self.is_werewolf[i]]
-        if len(werewolves) == 0:
-            self.game_over(protocol.ROLE_CIVILIAN)
-            return
-        elif len(werewolves) >= len(civilians):
-            self.game_over(protocol.ROLE_WEREWOLF)
-            return
-
-        if self.time == protocol.TIME_NIGHT:
-            self.time = protocol.TIME_DAY
-            self.day += 1
-            self.retry_vote = 2
-            self.selected_kpu_id = None
-            self.vote_kpu_id = [None] * self.MAX_PLAYER
-        else:
-            self.time = protocol.TIME_NIGHT
-
-        data = {
-            protocol.METHOD: protocol.METHOD_CHANGE_PHASE,
-            protocol.TIME: self.time,
-            protocol.DAYS: self.day
-        }
-        if self.time == protocol.TIME_DAY:
-            data[protocol.DESCRIPTION] = (
-                "Dan pagi hari telah menjelang, warga desa perlahan "
-                "terbangun dari tidurnya. Semuanya karakter berubah menjadi "
-                "rakyat biasa. Tadi malam, seorang warga bernama '%s' ditemukan tewas.") % (self.player_name[self.player_killed])
-        else:
-            str_desc = ""
-            if self.player_killed is None:
-                str_desc += (
-                    "Rapat bejalan alot. Walau telah dilakukan pemilihan sebanyak 2x, "
-                    "perundingan para warga tidak menghasilkan apapun. "
-                    "Tidak ada yang terbunuh di siang itu."
-                )
-            else:
-                str_desc += (
-                    "Setelah berunding, warga desa memilih untuk membunuh '%s'. ") % (self.player_name[self.player_killed])
-                if self.is_werewolf[self.player_killed]:
-                    str_desc += (
-                        "Untungnya dia adalah seorang werewolf.")
-                else:
-                    str_desc += (
-                        "Namun sayangnya dia hanyalah seorang warga biasa tak berdosa...")
-            str_desc += "\n\n"
-
-            data[protocol.DESCRIPTION] = str_desc + (
-                "Saat ini, hari telah malam, warga desa yang "
-                "kelelahan kini mulai perlahan terlelap. Werewolf pun "
-                "beraksi...")
-        self.player_killed = None
-        self.broadcast(data)
-
-        if self.time == protocol.TIME_NIGHT:
-            self.vote_now()
-
-    def kpu_selected(self, kpu_id):
-        data = {
-            protocol.METHOD: protocol.METHOD_KPU_SELECTED,
-            protocol.KPU_ID: kpu_id
-        }
-        self.broadcast(data)
-
-    def vote_now(self):
-        if self.time == protocol.TIME_DAY:
-            if self.retry_vote > 0:
-                self.retry_vote -= 1
-            else:
-                self.change_phase()
+    def accept_client(self):
+        if self.channel is None:
+            client_socket, client_addr = self.socket.accept()
+            return client_socket, client_addr, b""
+        return recv_handoff(self.socket)
+
+    def get_room(self, name):
+        with self.lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = Room(name, metrics=self.metrics, **self.rules)
+                self.rooms[name] = room
+            return room
+
+    def release_room(self, room):
+        with self.lock, room.lock:
+            if room.player_count > 0 or room.is_closed:
                 return
-        data = {
-            protocol.METHOD: protocol.METHOD_VOTE_NOW,
-            protocol.PHASE: self.time
-        }
-        self.broadcast(data)
-
-    def game_over(self, winner):
-        str_desc = "Permainan telah berakhir. "
-        if self.player_killed is not None:
-            str_desc += (
-                "Pemain '%s' terbunuh.\n") % (self.player_name[self.player_killed])
-        data = {
-            protocol.METHOD: protocol.METHOD_GAME_OVER,
-            protocol.WINNER: winner,
-            protocol.DESCRIPTION: str_desc + "Pemenangnya adalah: %s!" % (winner)
-        }
-        self.broadcast(data)
+            room.is_closed = True
+            if self.rooms.get(room.name) is room:
+                del self.rooms[room.name]
 
 class Connection(threading.Thread):
 
-    def __init__(self, server, client_socket, client_addr):
+    def __init__(self, server, client_socket, client_addr, data=b""):
         super().__init__()
 
-        self.verbose = True
         self.buf_size = 2048
         self.timeout = 1
+        self.max_iov = 64
 
         self.server = server
         self.socket = client_socket
         self.addr = client_addr
+        self.data = data
         self.handler = Handler(server, self)
+        self.framer = Framer()
+        set_keepalive(client_socket, server.idle_timeout, server.heartbeat_interval)
+
+        # other connections' threads broadcast through this one too, they
+        # only queue their frames and the writer thread sends them, so a
+        # stalled client holds up nobody but itself
+        self.outbox = Outbox(**server.outbox_limits)
+        self.send_lock = threading.Lock()
+        self.writable = threading.Condition(self.send_lock)
+        self.is_closed = False
+        self.writer = threading.Thread(target=self.write)
+
+        # a send waits for the socket at most this long, then tries again
+        self.socket.settimeout(self.timeout)
 
     def run(self):
-        messages = []
+        self.writer.start()
+
+        # bytes the supervisor already read while routing this connection
+        message = self.data
         while self.server.keep_running:
             try:
-                # check socket if it is ready to read
-                readable, _, _ = select.select([self.socket], [], [], self.timeout)
-                if self.socket not in readable:
-                    continue
-
-                # receive the packet
-                message = self.socket.recv(self.buf_size)
-
-                # client is disconnected
-                if not message:
-                    self.verbose and print(
-                        "Client", str(self.addr),
-                        "disconnected, exiting...")
+                if self.handler.check_idle(time.monotonic()):
                     break
 
-                # decode and strip extra newline, continue if empty
-                message = message.decode('utf-8').strip("\n")
                 if not message:
-                    continue
+                    # check socket if it is ready to read
+                    readable, _, _ = select.select([self.socket], [], [], self.timeout)
+                    if self.socket not in readable:
+                        continue
 
-                messages.append(message)
-                self.verbose and print(
-                    "Received", len(message), "bytes:", message)
+                    # receive the packet
+                    message = self.socket.recv(self.buf_size)
 
-                # keep recv until PROTOCOL_END is received
-                if not message.endswith(protocol.PROTOCOL_END):
-                    continue
+                    # client is disconnected
+                    if not message:
+                        logger.debug("Client %s disconnected", self.addr)
+                        break
 
-                full_message = "".join(messages)
-                self.handler.handle(full_message)
-                messages.clear()
+                if log.sample_payload():
+                    logger.debug("Received %d bytes from %s: %r", len(message), self.addr, message)
+
+                # handle every complete frame, keep the rest for next recv
+                self.handler.feed(message)
+                message = b""
 
             except select.error:
                 break
 
-            except Exception as e:
-                print(e)
+            except FramingError as e:
+                logger.warning("Dropping client %s: %s", self.addr, e)
+                break
+
+            except Exception:
+                logger.exception("Dropping client %s", self.addr)
                 break
 
-        self.handler.handle_leave()
+        self.handler.close()
+        # the writer sends what is left, unless the client stopped reading
+        with self.writable:
+            self.is_closed = True
+            self.writable.notify()
+        self.writer.join()
         self.socket.close()
 
-    def send(self, message):
-        if isinstance(message, bytes):
+    def write(self):
+        while True:
+            with self.writable:
+                while not self.outbox and not self.is_closed:
+                    self.writable.wait()
+                if not self.outbox:
+                    return
+                # put() may coalesce while the lock is released, but never
+                # the frames taken here
+                frames = self.outbox.take(self.max_iov)
+
+            if log.sample_payload():
+                logger.debug("Sending to %s: %r", self.addr, b"".join(frames))
+            try:
+                sent = self.socket.sendmsg(frames)
+            except socket.timeout:
+                if self.is_closed or not self.server.keep_running:
+                    return
+                sent = 0
+            except OSError:
+                # the peer is gone, the reader sees it too
+                with self.writable:
+                    self.is_closed = True
+                    self.outbox.consume(0)
+                    self.outbox.clear()
+                return
+
+            with self.writable:
+                self.outbox.consume(sent)
+                # an overflow aborted the connection while sending
+                if self.outbox.overflowed:
+                    self.outbox.clear()
+                    return
+
+    def abort(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
             pass
-        elif isinstance(message, str):
-            message = message.encode() + b"\n"
-        else:
-            message = (json.dumps(message) + "\n").encode()
 
-        total_sent = 0
-        while self.server.keep_running and total_sent < len(message):
-            _, writable, _ = select.select([], [self.socket], [], self.timeout)
-            if self.socket not in writable:
-                continue
+    def send(self, message, method=None):
+        with self.send_lock:
+            if self.is_closed:
+                return
+            data = self.framer.encode(message)
+            if not enqueue(self, data, method):
+                return
+            self.writable.notify()
 
-            self.verbose and print("Sending:", message)
-            sent = self.socket.send(message[total_sent:])
-            if sent == 0:
-                break
-            total_sent += sent
+        hooks = self.server.hooks
+        hooks is not None and hooks.sent(self.handler, message, len(data), method)
@@ -0,0 +1,226 @@
+import logging
+import os
+import signal
+import socket
+import selectors
+import json
+import zlib
+
+from common import log
+from common import protocol
+from common.framing import Framer
+
+logger = logging.getLogger(__name__)
+
+# bytes the supervisor reads from a connection before its first frame is
+# complete, and the largest handoff: those bytes behind the client address.
+# A SEQPACKET receive cuts off whatever does not fit its buffer.
+MAX_PENDING = 65536
+MAX_HANDOFF = MAX_PENDING + 256
+
+
+def send_handoff(channel, client_socket, client_addr, data):
+    message = json.dumps(list(client_addr)).encode() + b"\n" + data
+    if len(message) > MAX_HANDOFF:
+        raise ValueError("Handoff of %d bytes does not fit the worker's buffer" % len(message))
+    socket.send_fds(channel, [message], [client_socket.fileno()])
+
+
+def recv_handoff(channel, buf_size=MAX_HANDOFF):
+    message, fds, _, _ = socket.recv_fds(channel, buf_size, 1)
+    if not fds:
+        return None
+
+    addr, _, data = message.partition(b"\n")
+    client_socket = socket.socket(fileno=fds[0])
+    return client_socket, tuple(json.loads(addr)), data
+
+
+class Supervisor:
+    """Accepts every connection in the parent process and hands it to one
+    of the worker processes. The first frame tells which room the player
+    joins, and the room name always maps to the same worker, so players
+    of one game share a process. Only the first room counts: a player who
+    leaves it and joins another on the same connection stays on the worker
+    it was handed to, and has to reconnect to follow the routing."""
+
+    def __init__(self, host='', port=9999, workers=2, engine=None, rules=None,
+                 metrics_port=None, profile_rate=0, outbox_limits=None,
+                 heartbeat_interval=10, idle_timeout=30, profile_dir=None):
+        self.keep_running = True
+        self.buf_size = 2048
+        self.max_pending = MAX_PENDING
+
+        self.host = host
+        self.port = port
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        self.socket.setblocking(False)
+
+        self.workers = workers
+        self.engine = engine
+        self.rules = rules
+        # every worker serves its own metrics, on consecutive ports
+        self.metrics_port = metrics_port
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self.outbox_limits = outbox_limits
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.channels = []
+        self.pids = []
+
+        self.selector = selectors.DefaultSelector()
+        self.pending = {}
+
+    def _spawn(self):
+        for i in range(self.workers):
+            self.channels.append(None)
+            self.pids.append(None)
+            self._start(i)
+
+    def _start(self, i):
+        channel, worker_channel = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+        pid = os.fork()
+        if pid == 0:
+            # the child keeps nothing of the supervisor but its channel
+            channel.close()
+            self.selector.close()
+            self.socket.close()
+            for other in self.channels:
+                if other is not None:
+                    other.close()
+            for client_socket in self.pending:
+                client_socket.close()
+            metrics_port = None
+            if self.metrics_port is not None:
+                metrics_port = self.metrics_port + i
+            try:
+                self.engine(channel=worker_channel, rules=self.rules,
+                            metrics_port=metrics_port,
+                            profile_rate=self.profile_rate,
+                            outbox_limits=self.outbox_limits,
+                            heartbeat_interval=self.heartbeat_interval,
+                            idle_timeout=self.idle_timeout,
+                            profile_dir=self.profile_dir).serve_forever()
+            finally:
+                log.shutdown()
+                os._exit(0)
+
+        worker_channel.close()
+        self.channels[i] = channel
+        self.pids[i] = pid
+        logger.info("Started worker %d (pid %d)", i, pid)
+
+    def _restart(self, i):
+        """Replaces a worker that is gone, its rooms are lost but the rooms
+        mapping to it get a process again."""
+        self.channels[i].close()
+        try:
+            os.waitpid(self.pids[i], 0)
+        except ChildProcessError:
+            pass
+        logger.error("Worker %d (pid %d) is gone, restarting it", i, self.pids[i])
+        self._start(i)
+
+    def route(self, room):
+        return zlib.crc32(room.encode()) % len(self.channels)
+
+    def _forward(self, signum, frame):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def serve_forever(self):
+        try:
+            self._spawn()
+            # profiling signals are meant for the workers
+            if hasattr(signal, "SIGUSR1"):
+                signal.signal(signal.SIGUSR1, self._forward)
+                signal.signal(signal.SIGUSR2, self._forward)
+            self.selector.register(self.socket, selectors.EVENT_READ)
+            logger.info("Listening to client connections on port %d", self.port)
+            while self.keep_running:
+                for key, mask in self.selector.select():
+                    if key.fileobj is self.socket:
+                        self._accept()
+                    else:
+                        self._recv(key.fileobj)
+
+        except KeyboardInterrupt:
+            logger.info("Terminated by user")
+
+        finally:
+            self.keep_running = False
+            for client_socket in self.pending:
+                client_socket.close()
+            self.selector.close()
+            self.socket.close()
+
+            # workers stop once their channel is closed
+            for channel in self.channels:
+                channel.close()
+            for pid in self.pids:
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+
+    def _accept(self):
+        try:
+            client_socket, client_addr = self.socket.accept()
+        except BlockingIOError:
+            return
+        logger.debug("Connection from %s", client_addr)
+
+        client_socket.setblocking(False)
+        self.pending[client_socket] = (client_addr, bytearray(), Framer())
+        self.selector.register(client_socket, selectors.EVENT_READ)
+
+    def _recv(self, client_socket):
+        client_addr, data, framer = self.pending[client_socket]
+        try:
+            message = client_socket.recv(self.buf_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            message = b""
+
+        if not message or len(data) + len(message) > self.max_pending:
+            self._drop(client_socket)
+            return
+
+        data += message
+        try:
+            first = next(framer.feed(message), None)
+        except ValueError:
+            self._drop(client_socket)
+            return
+        if first is None:
+            return
+
+        room = protocol.ROOM_DEFAULT
+        if first.get(protocol.METHOD) == protocol.METHOD_JOIN:
+            room = str(first.get(protocol.ROOM, room)).strip() or room
+
+        worker = self.route(room)
+        logger.debug("Handing %s in room '%s' to worker %d", client_addr, room, worker)
+        try:
+            send_handoff(self.channels[worker], client_socket, client_addr, bytes(data))
+        except ValueError:
+            logger.warning("Dropping client %s, its first frame is too large", client_addr)
+        except OSError:
+            logger.warning("Dropping client %s, worker %d did not take it", client_addr, worker)
+            self._restart(worker)
+        self._drop(client_socket)
+
+    def _drop(self, client_socket):
+        self.selector.unregister(client_socket)
+        del self.pending[client_socket]
+        client_socket.close()
@@ -0,0 +1,48 @@
+"""
+Module containing the simulated game: bots and a server in one process,
+on a virtual clock and seeded random generators
+"""
+
+import random
+
+from client.bot import Bot, BotGame, STRATEGIES
+from common.clock import VirtualClock
+from sim.network import Network, SimServer
+
+
+def play(seed, players=6, strategy="random", rules=None, latency=0.001, timeout=3600,
+         faults=None, **kwargs):
+    """Plays one game of bots to the end and returns its BotGame, with the
+    virtual time it took, the days played and a checksum of the traffic.
+    The same seed and arguments play the same game. kwargs go to every
+    Bot, e.g. election, reliable or loss; timeout is in virtual seconds."""
+    rng = random.Random(seed)
+    clock = VirtualClock()
+    server = SimServer(dict(rules or {}, rng=random.Random(rng.random())))
+    network = Network(clock, server, latency)
+
+    bots = []
+    for i in range(players):
+        bot = Bot(None, None, "bot-%d" % i, "sim", STRATEGIES[strategy](random.Random(rng.random())),
+                  faults=dict(faults or {}, seed=rng.random()), clock=clock,
+                  rng=random.Random(rng.random()), connection=network.connect, **kwargs)
+        bot.hold = True
+        bots.append(bot)
+
+    game = BotGame("sim", bots, clock.now())
+
+    def wake():
+        # leftover retransmissions and acks do not count
+        if not game.step():
+            clock.stop()
+
+    network.wake = wake
+    clock.call_later(0, wake)
+    clock.run(timeout)
+
+    game.step()
+    game.close(clock.now())
+    game.seed = seed
+    game.days = max(bot.game_day for bot in bots)
+    game.digest = network.digest
+    return game
@@ -0,0 +1,142 @@
+"""
+Module containing the in-memory network of a simulated game: the server and
+the players exchange the same framed bytes as over sockets, delivered as
+timers on a virtual clock
+"""
+
+import collections
+import itertools
+import threading
+import zlib
+
+from client.client import Connection
+from client.reliable import ReliableChannel
+from common.framing import Framer
+from server.handler import Handler
+from server.server import Server
+
+
+class SimServer(Server):
+    """The rooms of a Server without its sockets or instrumentation."""
+
+    def __init__(self, rules=None):
+        # Server.__init__ binds a socket, only its bookkeeping is needed
+        self.keep_running = True
+        self.rules = rules or {}
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.hooks = None
+        self.metrics = None
+        self.profiler = None
+
+
+class Network:
+    """Links players to one server and to each other. Every delivery is a
+    timer latency seconds away, so messages on a link arrive in order; the
+    faults of each client decide what it sends. A checksum over everything
+    delivered tells whether two runs took the same course.
+
+    wake() is called after every delivery, once its handler returned."""
+
+    def __init__(self, clock, server, latency=0.001, wake=None):
+        self.clock = clock
+        self.server = server
+        self.latency = latency
+        self.wake = wake
+
+        self.ports = itertools.count(10000)
+        self.peers = {}
+        self.digest = 0
+
+    def connect(self, client, handler, host, port):
+        """Connection factory for Client, host and port are ignored."""
+        connection = SimConnection(self, client, handler)
+        self.peers[connection.address, connection.port] = connection
+        return connection
+
+    def deliver(self, receive, data, *args):
+        self.digest = zlib.crc32(data, self.digest)
+        self.clock.call_later(self.latency, self._deliver, receive, data, *args)
+
+    def _deliver(self, receive, data, *args):
+        receive(data, *args)
+        if self.wake is not None:
+            self.wake()
+
+
+class ServerConnection:
+    """The server end of a player's connection."""
+
+    def __init__(self, network, peer):
+        self.network = network
+        self.peer = peer
+        self.addr = (peer.address, peer.port)
+        self.framer = Framer()
+        self.handler = Handler(network.server, self)
+        self.is_closed = False
+
+    def receive(self, data):
+        if not self.is_closed:
+            self.handler.feed(data)
+
+    def send(self, message, method=None):
+        if not self.is_closed:
+            self.network.deliver(self.peer.server_receive, self.framer.encode(message))
+
+    def close(self):
+        if not self.is_closed:
+            self.is_closed = True
+            self.handler.close()
+
+
+class SimConnection(Connection):
+    """The player end, a Connection that runs on the network instead of
+    sockets and threads."""
+
+    def __init__(self, network, client, handler):
+        # Connection.__init__ opens the sockets, set up the same state
+        self.network = network
+        self.client = client
+        self.handler = handler
+
+        self.server_framer = Framer()
+        self.framer = Framer()
+        self.framers = collections.defaultdict(Framer)
+        self.loss = client.loss
+        self.faults = client.faults
+        self.channel = ReliableChannel(self, client.clock) if client.reliable else None
+
+        self.address = "127.0.0.1"
+        self.port = next(network.ports)
+
+        self.lock = threading.Lock()
+        self.requests = collections.deque()
+        self.server = ServerConnection(network, self)
+
+    def close(self):
+        self.server.close()
+
+    def server_receive(self, data):
+        if not self.client.keep_running:
+            return
+        for m in self.server_framer.feed(data):
+            self.handler.server_handle(m)
+
+    def receive(self, data, address):
+        if not self.client.keep_running:
+            return
+        for m in self.framers[address].feed(data):
+            if self.channel is not None:
+                m = self.channel.receive(m, address)
+                if m is None:
+                    continue
+            self.handler.handle(m, address)
+
+    def _server_write(self, message):
+        if self.client.keep_running:
+            self.network.deliver(self.server.receive, self.server_framer.encode(message))
+
+    def _transmit(self, message, address):
+        peer = self.network.peers.get(address)
+        if peer is not None and self.client.keep_running:
+            self.network.deliver(peer.receive, self.framer.encode(message), (self.address, self.port))
@@ -0,0 +1,68 @@
+import json
+import unittest
+
+from common import protocol
+from common.framing import Framer, FramingError
+
+
+class FramerTest(unittest.TestCase):
+
+    def feed(self, framer, chunks):
+        messages = []
+        for chunk in chunks:
+            messages.extend(framer.feed(chunk))
+        return messages
+
+    def test_split_chunks(self):
+        messages = [{"method": "join", "username": "a" * 50}, {"status": "ok", "n": [1, {"x": 2}]}]
+        data = b"".join(Framer().encode(message) for message in messages)
+
+        for size in (1, 2, 3, 7, len(data)):
+            chunks = [data[i:i+size] for i in range(0, len(data), size)]
+            self.assertEqual(self.feed(Framer(), chunks), messages)
+
+    def test_braces_and_quotes_in_strings(self):
+        message = {"description": "a {\"quoted\"} } { \\\" \\\\", "nested": {"s": "}}"}}
+        data = json.dumps(message).encode() + b"\n"
+
+        self.assertEqual(self.feed(Framer(), [data]), [message])
+        # an escape cut off at the end of a chunk
+        pos = data.index(b"\\")
+        self.assertEqual(self.feed(Framer(), [data[:pos+1], data[pos+1:]]), [message])
+
+    def test_garbage_between_frames(self):
+        data = b'  \r\nxx{"a": 1}\n junk {"b": 2}'
+        self.assertEqual(self.feed(Framer(), [data]), [{"a": 1}, {"b": 2}])
+
+    def test_switch_in_buffer(self):
+        # the join reply switches the format, the frames behind it in the
+        # same buffer are already length-prefixed
+        sender = Framer()
+        sender.set_format(protocol.FRAMING_LENGTH, protocol.CODEC_STRUCT)
+        ready = {protocol.METHOD: protocol.METHOD_READY}
+        kpu = {protocol.METHOD: protocol.METHOD_KPU_SELECTED, protocol.KPU_ID: 3}
+        data = b'{"method": "join"}\r\n' + sender.encode(ready) + sender.encode(kpu)
+
+        for split in (len(data), 19, 20, 21, 23):
+            framer = Framer()
+            messages = []
+            for chunk in (data[:split], data[split:]):
+                for message in framer.feed(chunk):
+                    messages.append(message)
+                    if message.get(protocol.METHOD) == protocol.METHOD_JOIN:
+                        framer.set_format(protocol.FRAMING_LENGTH, protocol.CODEC_STRUCT)
+            self.assertEqual(messages, [{"method": "join"}, ready, kpu])
+
+    def test_length_frame_limit(self):
+        framer = Framer(max_frame=16)
+        framer.set_format(protocol.FRAMING_LENGTH, protocol.CODEC_JSON)
+        with self.assertRaises(FramingError):
+            self.feed(framer, [b'{"me'])
+
+    def test_json_frame_limit(self):
+        with self.assertRaises(FramingError):
+            self.feed(Framer(max_frame=16), [b'{"method": "', b'a' * 20])
+
+
+if __name__ == "__main__":
+    unittest.main()
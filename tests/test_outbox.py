@@ -0,0 +1,94 @@
+import unittest
+
+from common import protocol
+from server.outbox import Outbox, DISCONNECT
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_coalesce_drops_superseded(self):
+        outbox = Outbox(max_bytes=40)
+        outbox.put(b"a" * 10)
+        outbox.put(b"k" * 10, protocol.METHOD_KPU_SELECTED)
+        outbox.put(b"b" * 10)
+        self.assertTrue(outbox.put(b"l" * 10, protocol.METHOD_KPU_SELECTED))
+        self.assertTrue(outbox.put(b"c" * 5))
+
+        self.assertEqual(b"".join(outbox.frames), b"a" * 10 + b"b" * 10 + b"l" * 10 + b"c" * 5)
+        self.assertEqual(outbox.size, 35)
+        self.assertEqual(outbox.dropped, 1)
+
+    def test_coalesce_within_phase(self):
+        outbox = Outbox(max_bytes=40)
+        outbox.put(b"a" * 5)
+        outbox.put(b"k" * 10, protocol.METHOD_KPU_SELECTED)
+        outbox.put(b"p" * 10, protocol.METHOD_CHANGE_PHASE)
+        outbox.put(b"l" * 10, protocol.METHOD_KPU_SELECTED)
+        # another day's KPU is not superseded, the outbox overflows
+        self.assertFalse(outbox.put(b"b" * 10))
+        self.assertEqual(outbox.dropped, 0)
+
+    def test_coalesce_keeps_frames_in_flight(self):
+        outbox = Outbox(max_bytes=30)
+        outbox.put(b"a" * 10)
+        outbox.put(b"k" * 10, protocol.METHOD_KPU_SELECTED)
+        outbox.put(b"b" * 5)
+
+        # a writer takes the frames and sends them without the lock, a
+        # newer kpu_selected comes in meanwhile
+        frames = outbox.take(64)
+        # the older one is being sent and cannot be dropped, so it overflows
+        self.assertFalse(outbox.put(b"l" * 10, protocol.METHOD_KPU_SELECTED))
+        outbox.consume(sum(len(frame) for frame in frames))
+
+        self.assertEqual(outbox.dropped, 0)
+        self.assertEqual(b"".join(outbox.frames), b"l" * 10)
+        self.assertEqual(outbox.size, 10)
+
+    def test_partial_send_with_coalesce(self):
+        outbox = Outbox(max_bytes=40)
+        outbox.put(b"a" * 10)
+        outbox.put(b"k" * 10, protocol.METHOD_KPU_SELECTED)
+        outbox.put(b"b" * 10)
+
+        outbox.take(64)
+        outbox.put(b"l" * 10, protocol.METHOD_KPU_SELECTED)
+        outbox.put(b"m" * 10, protocol.METHOD_KPU_SELECTED)
+        # only what came in after the taken frames is coalesced
+        self.assertEqual(outbox.dropped, 1)
+        outbox.consume(15)
+
+        self.assertEqual(b"".join(outbox.frames), b"k" * 5 + b"b" * 10 + b"m" * 10)
+        self.assertEqual(outbox.size, 25)
+
+    def test_clear_while_sending(self):
+        outbox = Outbox(max_bytes=30)
+        outbox.put(b"a" * 10)
+        outbox.put(b"b" * 10)
+
+        frames = outbox.take(1)
+        # the client overflows and is disconnected while the writer sends
+        self.assertFalse(outbox.put(b"c" * 20))
+        outbox.clear()
+        self.assertEqual(outbox.size, 10)
+        outbox.consume(sum(len(frame) for frame in frames))
+
+        self.assertEqual(len(outbox), 0)
+        self.assertEqual(outbox.size, 0)
+
+    def test_overflow(self):
+        outbox = Outbox(max_bytes=20, policy=DISCONNECT)
+        self.assertTrue(outbox.put(b"a" * 50))
+        self.assertFalse(outbox.put(b"k" * 10, protocol.METHOD_KPU_SELECTED))
+        self.assertTrue(outbox.overflowed)
+        self.assertFalse(outbox.put(b"b"))
+
+    def test_message_limit(self):
+        outbox = Outbox(max_messages=2)
+        self.assertTrue(outbox.put(b"a"))
+        self.assertTrue(outbox.put(b"b"))
+        self.assertFalse(outbox.put(b"c"))
+
+
+if __name__ == "__main__":
+    unittest.main()